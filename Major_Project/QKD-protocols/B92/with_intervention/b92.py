@@ -1,13 +1,14 @@
 from helpers import *
 from qiskit import IBMQ
 
-def b92():
+def b92(single_job=True, entropy_source=ENTROPY_SOURCE):
   use_simulator = input("Run using simulator?(y/n): ").lower()
   shots = 1
   backend = QasmSimulator()
   accuracy = 100
 
-  size = int(input("Enter desired length of bits (max:29): "))
+  size = int(input("Enter desired length of bits: "))
+  set_entropy_source(entropy_source)
   alice_bits = get_random_sequence_of_bits(size)
   bob_bits = get_random_sequence_of_bits(size)
   eve_bits = get_random_sequence_of_bits(size)
@@ -25,30 +26,36 @@ def b92():
   bob_bases = get_bases_from_bits(bob_bits)
   eve_bases = get_bases_from_bits(eve_bits)
   size = len(alice_bits)
-  circuit = QuantumCircuit(size, size)
+  circuits = get_block_circuits(size, registers=2 if single_job else 1)
 
-  initialize_circuit_with_zeros(circuit)
-  insert_states_in_circuit(circuit, alice_states)
+  insert_states_in_blocks(circuits, alice_states)
 
-  # Eve makes measurements
-  insert_measurements_according_to_base(eve_bases, circuit)
-  circuit.barrier()
-  eve_measurements = get_measurements_result(backend, circuit, shots, accuracy, size)
-  eve_states_for_bob = get_states(eve_measurements, eve_bases)
-  reset_circuit(circuit, size)
-  insert_states_in_circuit(circuit, eve_states_for_bob)
-
-  insert_measurements_according_to_base(bob_bases, circuit)
+  if single_job:
+    # Eve measures and resends, then Bob measures, in the same shots
+    insert_intercept_resend_in_blocks(eve_bases, bob_bases, circuits)
+    # vector contains bob's measurements
+    eve_measurements, vector = get_intercept_measurements_result(backend, circuits, shots, accuracy)
+  else:
+    # Eve makes measurements
+    insert_measurements_in_blocks(eve_bases, circuits)
+    for circuit in circuits:
+      circuit.barrier()
+    eve_measurements = get_blocks_measurements_result(backend, circuits, shots, accuracy)
+    eve_states_for_bob = get_states(eve_measurements, eve_bases)
+    reset_blocks(circuits)
+    insert_states_in_blocks(circuits, eve_states_for_bob)
+
+    insert_measurements_in_blocks(bob_bases, circuits)
 
     # vector contains bob's measurements
-  vector = get_measurements_result(backend, circuit, shots, accuracy, size)
+    vector = get_blocks_measurements_result(backend, circuits, shots, accuracy)
     
   new_vector_alice = get_sub_vector(alice_bits, vector)
   new_vector_bob = get_sub_vector(bob_bits, vector)
   new_vector_eve = get_sub_vector(eve_measurements, vector)
 
 
-  save_circuit_image(circuit, "b92_circuit_with_eve")
+  save_circuit_image(circuits[0], "b92_circuit_with_eve")
   print("\nB92 protocol with intervention\n")
   print(f"Alice bits:       {alice_bits}")
   print(f"Alice states:     {alice_states}")
@@ -88,7 +95,9 @@ def b92():
 
   privacy_amplification = input("Perform privacy amplification?(y/n): ").lower()
   if privacy_amplification == "y":
-      perform_privacy_amplification(new_vector_alice, new_vector_bob)
+      new_vector_alice, new_vector_bob = perform_privacy_amplification(
+          PackedKey.from_bits(new_vector_alice), PackedKey.from_bits(new_vector_bob)
+      )
 
   encrypt = input("Encrypt message?(y/n): ").lower()
   if encrypt == "y":
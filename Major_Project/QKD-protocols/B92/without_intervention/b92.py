@@ -1,13 +1,14 @@
 from helpers import *
 from qiskit import IBMQ
 
-def b92():
+def b92(entropy_source=ENTROPY_SOURCE):
   use_simulator = input("Run using simulator?(y/n): ").lower()
   shots = 1
   backend = QasmSimulator()
   accuracy = 100
 
-  size = int(input("Enter desired length of bits (max:29): "))
+  size = int(input("Enter desired length of bits: "))
+  set_entropy_source(entropy_source)
   alice_bits = get_random_sequence_of_bits(size)
   bob_bits = get_random_sequence_of_bits(size)
     
@@ -23,21 +24,20 @@ def b92():
   alice_states = get_states_from_bits(alice_bits)
   bob_bases = get_bases_from_bits(bob_bits)
   size = len(alice_bits)
-  circuit = QuantumCircuit(size, size)
-  initialize_circuit_with_zeros(circuit)
+  circuits = get_block_circuits(size)
 
-  insert_states_in_circuit(circuit, alice_states)
+  insert_states_in_blocks(circuits, alice_states)
 
-  insert_measurements_according_to_base(bob_bases, circuit)
+  insert_measurements_in_blocks(bob_bases, circuits)
 
     # vector contains bob's measurements
-  vector = get_measurements_result(backend, circuit, shots, accuracy, size)
+  vector = get_blocks_measurements_result(backend, circuits, shots, accuracy)
     
   new_vector_alice = get_sub_vector(alice_bits, vector)
   new_vector_bob = get_sub_vector(bob_bits, vector)
 
 
-  save_circuit_image(circuit, "b92_circuit_without_eve")
+  save_circuit_image(circuits[0], "b92_circuit_without_eve")
   print("\nB92 protocol without intervention\n")
   print(f"Alice bits:   {alice_bits}")
   print(f"Alice states: {alice_states}")
@@ -72,7 +72,9 @@ def b92():
 
   privacy_amplification = input("Perform privacy amplification?(y/n): ").lower()
   if privacy_amplification == "y":
-      perform_privacy_amplification(new_vector_alice, new_vector_bob)
+      new_vector_alice, new_vector_bob = perform_privacy_amplification(
+          PackedKey.from_bits(new_vector_alice), PackedKey.from_bits(new_vector_bob)
+      )
 
   encrypt = input("Encrypt message?(y/n): ").lower()
   if encrypt == "y":
@@ -5,4 +5,17 @@ X_BASE = "X"
 STATE_0 = "|0>"
 STATE_1 = "|1>"
 STATE_PLUS = "|+>"
-STATE_MINUS = "|->"
\ No newline at end of file
+STATE_MINUS = "|->"
+BLOCK_SIZE = 16
+STABILIZER_METHOD = "stabilizer"
+MPS_METHOD = "matrix_product_state"
+STATEVECTOR_METHOD = "statevector"
+MAX_STATEVECTOR_QUBITS = 24
+CLIFFORD_INSTRUCTIONS = ["id", "x", "y", "z", "h", "s", "sdg", "cx", "cy", "cz", "swap", "reset", "measure", "barrier"]
+CIRCUIT_ENTROPY = "circuit"
+QRNG_ENTROPY = "qrng"
+CSPRNG_ENTROPY = "csprng"
+ENTROPY_SOURCE = QRNG_ENTROPY
+ENTROPY_POOL_SIZE = 1 << 16
+ENTROPY_REFILL_THRESHOLD = 1 << 14
+PRIVACY_EPSILON = 1e-10
@@ -0,0 +1,267 @@
+import hmac
+import struct
+import time
+import numpy as np
+from functools import lru_cache
+from constants import AUTH_HASH_LANES
+
+# ============================
+# GF(2^64) arithmetic
+# ============================
+# field elements are 64-bit integers, reduced by x^64 + x^4 + x^3 + x + 1
+GF64_REDUCTION = 0x1B
+GF64_MASK = (1 << 64) - 1
+FOLD_RADIX = 16
+
+
+def gf64_multiply(a, b):
+    """Carry-less product of a and b, four bits of b at a time, then reduced."""
+    multiples = [0, a]
+    for i in range(2, 16):
+        multiples.append(multiples[i >> 1] << 1 if i % 2 == 0 else multiples[i - 1] ^ a)
+
+    product = 0
+    for shift in range(60, -4, -4):
+        product = (product << 4) ^ multiples[(b >> shift) & 0xF]
+
+    # x^64 = x^4 + x^3 + x + 1, twice since the first fold can carry past bit 63
+    for _ in range(2):
+        high = product >> 64
+        product = (product & GF64_MASK) ^ high ^ (high << 1) ^ (high << 3) ^ (high << 4)
+
+    return product
+
+
+def gf64_powers(c, n):
+    """c^0, c^1, ..., c^(n - 1)."""
+    powers = [1]
+    for _ in range(n - 1):
+        powers.append(gf64_multiply(powers[-1], c))
+
+    return powers
+
+
+def get_multiplication_tables(constants):
+    """
+    Multiplying by a fixed c is linear over GF(2), so c * w is the XOR of
+    table[j, byte j of w] over the eight bytes of w. Returns one (8, 256)
+    table per constant, each byte value built from a smaller one and a
+    single basis element.
+    """
+    # c * x^bit for every bit, all constants at once
+    basis = np.zeros((len(constants), 64), dtype=np.uint64)
+    c = np.array(constants, dtype=np.uint64)
+    for bit in range(64):
+        basis[:, bit] = c
+        c = (c << np.uint64(1)) ^ (c >> np.uint64(63)) * np.uint64(GF64_REDUCTION)
+
+    basis = basis.reshape(len(constants), 8, 8)
+    tables = np.zeros((len(constants), 8, 256), dtype=np.uint64)
+    for bit in range(8):
+        tables[:, :, 1 << bit:2 << bit] = tables[:, :, :1 << bit] ^ basis[:, :, bit, None]
+
+    return tables
+
+
+def get_multiplication_table(c):
+    return get_multiplication_tables([c])[0]
+
+
+def get_wide_table(table):
+    """The (8, 256) table of c merged into a (4, 65536) one for 16-bit chunks: half the lookups."""
+    pairs = table.reshape(4, 2, 256)
+    # entry (high byte << 8) | low byte of chunk j
+    return (pairs[:, 1, :, None] ^ pairs[:, 0, None, :]).reshape(4, 1 << 16)
+
+
+def multiply_words(words, table):
+    """c * w for every word of a uint64 array, with c's byte or 16-bit table."""
+    n_chunks = len(table)
+    chunks = np.ascontiguousarray(words).view(f"<u{8 // n_chunks}").reshape(*words.shape, n_chunks)
+
+    result = table[0].take(chunks[..., 0])
+    product = np.empty_like(result)
+    for j in range(1, n_chunks):
+        table[j].take(chunks[..., j], out=product)
+        result ^= product
+
+    return result
+
+
+# ============================
+# Polynomial hash
+# ============================
+def bytes_to_words(data, lanes):
+    """
+    The message as little-endian 64-bit words, followed by a word holding
+    its length in bytes and preceded by zero words up to a multiple of
+    lanes. Leading zeros do not change the polynomial, the length word
+    keeps messages differing only in trailing zero bytes apart.
+    """
+    n_words = len(data) // 8 + 1 if len(data) % 8 else len(data) // 8
+    n_rows = -(-(n_words + 1) // lanes)
+    words = np.zeros(n_rows * lanes, dtype="<u8")
+
+    start = len(words) - n_words - 1
+    words.view(np.uint8)[start * 8:start * 8 + len(data)] = np.frombuffer(data, dtype=np.uint8)
+    words[-1] = len(data)
+
+    return words.reshape(n_rows, lanes)
+
+
+# a hash key serves a whole authentication slice, so its tables are cached
+@lru_cache(maxsize=32)
+def get_fold_tables(hash_key, step):
+    """
+    Tables of the FOLD_RADIX powers that fold groups of lanes in one
+    lookup: k^16, ..., k^1 for the first step, which takes in the final
+    factor k of the hash, and K^15, ..., K^0 with K = k^(16^step) after it.
+    Flattened, so table b, byte j, value v sits at (b * 8 + j) * 256 + v.
+    """
+    if step == 0:
+        powers = gf64_powers(hash_key, FOLD_RADIX + 1)[:0:-1]
+    else:
+        base = hash_key
+        for _ in range(4 * step):
+            base = gf64_multiply(base, base)
+        powers = gf64_powers(base, FOLD_RADIX)[::-1]
+
+    return get_multiplication_tables(powers).reshape(-1)
+
+
+@lru_cache(maxsize=8)
+def get_stride_table(hash_key, lanes):
+    """16-bit table of k^lanes, which steps Horner's rule down the lanes of long messages."""
+    stride = hash_key
+    for _ in range(lanes.bit_length() - 1):
+        stride = gf64_multiply(stride, stride)
+
+    return get_wide_table(get_multiplication_table(stride))
+
+
+FOLD_OFFSETS = np.arange(FOLD_RADIX * 8).reshape(FOLD_RADIX, 8) * 256
+
+
+def fold_lanes(accumulators, fold_tables):
+    """XOR of lane b times power b over every group of FOLD_RADIX lanes, in one gather."""
+    groups = accumulators.reshape(-1, FOLD_RADIX).view(np.uint8).reshape(-1, FOLD_RADIX, 8)
+    products = fold_tables[groups + FOLD_OFFSETS]
+
+    return np.bitwise_xor.reduce(products.reshape(len(groups), -1), axis=1)
+
+
+def polynomial_hash(data, hash_key, lanes=AUTH_HASH_LANES):
+    """
+    H = sum of m_i * k^(N - i) over the N words m_i of the message, in
+    GF(2^64). Two messages of at most N words collide for at most N / 2^64
+    of the keys k.
+
+    The words are dealt across lanes, a power of FOLD_RADIX: Horner's rule
+    with k^lanes runs down all lanes at once, then every FOLD_RADIX
+    neighbouring lanes are folded into one with a single table lookup
+    until one value is left. A short message fits in one row, so it costs
+    a few folds and no Horner steps at all.
+    """
+    # up to FOLD_RADIX^2 words a message is one row, which folds away in a
+    # lookup or two; a longer one gets up to FOLD_RADIX rows per lane,
+    # since a fold over many lanes costs several Horner steps
+    n_words = -(-len(data) // 8) + 1
+    target_lanes = min(lanes, max(min(n_words, FOLD_RADIX ** 2), -(-n_words // FOLD_RADIX)))
+
+    fold_steps = 1
+    while FOLD_RADIX ** fold_steps < target_lanes:
+        fold_steps += 1
+    lanes = FOLD_RADIX ** fold_steps
+    words = bytes_to_words(data, lanes)
+
+    accumulators = words[0]
+    if len(words) > 1:
+        stride_table = get_stride_table(hash_key, lanes)
+        for row in words[1:]:
+            accumulators = multiply_words(accumulators, stride_table)
+            accumulators ^= row
+
+    for step in range(fold_steps):
+        accumulators = fold_lanes(accumulators, get_fold_tables(hash_key, step))
+
+    return int(accumulators[0])
+
+
+# ============================
+# Wegman-Carter tags
+# ============================
+# tag record: pool offset of the hash key, pool offset of the pad, tag
+TAG_RECORD = struct.Struct("<QQQ")
+
+
+class Authenticator:
+    """
+    Wegman-Carter authentication with keys from the key pool's
+    authentication slice: tag = H_k(message) XOR pad, where the hash key k
+    lasts for the whole slice and every tag uses a fresh 8-byte pad. The
+    tag record names the pool offsets, so the verifier reads the same key.
+    """
+
+    def __init__(self, key_pool):
+        self.key_pool = key_pool
+        self.last_pad_offset = -1
+
+    def sign(self, message):
+        key_offset, hash_key, pad_offset, pad = self.key_pool.take_authentication_pad()
+        tag = polynomial_hash(message, hash_key) ^ pad
+
+        return TAG_RECORD.pack(key_offset, pad_offset, tag)
+
+    def verify(self, message, record):
+        key_offset, pad_offset, tag = TAG_RECORD.unpack(record)
+
+        # a pad is never accepted twice, so a recorded tag cannot be replayed
+        if pad_offset <= self.last_pad_offset:
+            return False
+
+        hash_key, pad = self.key_pool.read_authentication_pad(key_offset, pad_offset)
+        expected = polynomial_hash(message, hash_key) ^ pad
+        if not hmac.compare_digest(expected.to_bytes(8, "little"), tag.to_bytes(8, "little")):
+            return False
+
+        self.last_pad_offset = pad_offset
+        return True
+
+
+# ============================
+# Speed check
+# ============================
+def benchmark_polynomial_hash(sizes=(1 << 10, 1 << 13, 1 << 16, 1 << 20, 1 << 24)):
+    rng = np.random.default_rng()
+    hash_key = int(rng.integers(1 << 63)) | 1
+
+    # the lane-parallel hash against plain Horner's rule, in one row and in several
+    for size in (1000, 40000):
+        data = rng.bytes(size)
+        horner = 0
+        for word in bytes_to_words(data, 1).reshape(-1):
+            horner = gf64_multiply(horner ^ int(word), hash_key)
+        assert polynomial_hash(data, hash_key) == horner
+
+    # what every new authentication slice pays once for its hash key
+    start = time.perf_counter()
+    polynomial_hash(rng.bytes(1 << 16), hash_key ^ 2)
+    print(f"tables for a new hash key: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    for size in sizes:
+        data = rng.bytes(size)
+        # the tables are built once per authentication slice, not per message
+        polynomial_hash(data, hash_key)
+
+        # best of five, so a busy machine does not skew the short messages
+        elapsed = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            polynomial_hash(data, hash_key)
+            elapsed = min(elapsed, time.perf_counter() - start)
+
+        print(f"{size:>10,} bytes: {elapsed * 1e6:10.0f} us, {size / elapsed / 1e6:8.1f} MB/s")
+
+
+if __name__ == "__main__":
+    benchmark_polynomial_hash()
@@ -89,13 +89,61 @@
 
 
 
-import json
-import random
+import queue
+import threading
+import numpy as np
+from math import log, sqrt
+from statistics import NormalDist
+from constants import (
+    EFFICIENT_Z_BIAS, KEY_BLOCK_SIZE, KEY_STREAM_DEPTH, BINARY_CHANNEL,
+    QBER_TEST_FRACTION, QBER_THRESHOLD,
+    SPRT_P0, SPRT_ALPHA, SPRT_BETA, SPRT_BATCH_SIZE, SPRT_ACCEPT, SPRT_ABORT, SPRT_CONTINUE,
+    CASCADE_RECONCILIATION, LDPC_RECONCILIATION, CONFIRMATION_FAILED
+)
 from helpers import (
-    get_random_sequence_of_bits,
-    get_random_sequence_of_bases,
+    get_biased_bases_mask,
+    get_sift_mask,
+    bits_to_array,
+    array_to_bit_string,
     print_protocol_details
 )
+from reconciliation import cascade, reveal_test_sample
+from ldpc import ldpc_reconcile
+from key_confirmation import confirm_keys
+from public_channel import (
+    make_channel,
+    unpack_channel,
+    write_public_channel,
+    read_public_channel,
+    sift_public_channel,
+    ChannelLogWriter,
+    read_channel_frames,
+    is_channel_log,
+    load_channel_offset,
+    save_channel_offset
+)
+
+# ============================
+# Protocol round
+# ============================
+def get_z_bias(z_bias, efficient):
+    # efficient BB84 biases both parties towards Z and keeps only Z matches
+    if z_bias is None:
+        return EFFICIENT_Z_BIAS if efficient else 0.5
+    return z_bias
+
+
+def run_protocol_round(key_length, z_bias, efficient, rng):
+    # bits and bases come from the same generator, so a seed fixes the whole
+    # round, and no circuit is built per round
+    alice_bits = rng.integers(0, 2, key_length, dtype=np.uint8)
+    alice_mask, bob_mask = get_biased_bases_mask((2, key_length), z_bias, rng)
+    sift_mask = get_sift_mask(alice_mask, bob_mask, z_bias, efficient)
+
+    channel = make_channel(alice_bits, alice_mask, bob_mask, z_bias, efficient)
+
+    return channel, array_to_bit_string(alice_bits[sift_mask])
+
 
 # ============================
 # Alice (Sender)
@@ -103,84 +151,410 @@ from helpers import (
 def generate_key_for_sender(
     public_channel_file,
     key_length=128,
-    z_bias=0.5,
-    verbose=False
+    z_bias=None,
+    verbose=False,
+    efficient=False,
+    seed=None,
+    channel_format=BINARY_CHANNEL
 ):
-    alice_bits = get_random_sequence_of_bits(key_length)
-    alice_bases = get_random_sequence_of_bases(key_length, z_bias)
-    bob_bases   = get_random_sequence_of_bases(key_length, z_bias)
+    z_bias = get_z_bias(z_bias, efficient)
+    rng = np.random.default_rng(seed)
+    channel, sifted_key = run_protocol_round(key_length, z_bias, efficient, rng)
 
     if verbose:
-        print_protocol_details(alice_bits, alice_bases, bob_bases)
+        print_protocol_details(*unpack_channel(channel))
 
-    public_data = {
-        "alice_bases": alice_bases,
-        "bob_bases": bob_bases,
-        "simulated_alice_bits": alice_bits
-    }
+    write_public_channel(public_channel_file, channel, channel_format)
 
-    with open(public_channel_file, "w") as f:
-        json.dump(public_data, f, indent=4)
+    return sifted_key
 
-    sifted_key = "".join(
-        alice_bits[i]
-        for i in range(key_length)
-        if alice_bases[i] == bob_bases[i]
-    )
 
-    return sifted_key
+# ============================
+# Streaming key blocks
+# ============================
+class KeyStream:
+    """
+    Sifted key blocks produced continuously on a background thread.
+    At most max_blocks blocks are buffered; the producer waits until the
+    consumer catches up, so memory stays bounded.
+    """
+
+    def __init__(
+        self,
+        block_size=KEY_BLOCK_SIZE,
+        max_blocks=KEY_STREAM_DEPTH,
+        round_length=128,
+        z_bias=None,
+        efficient=False,
+        seed=None,
+        public_channel_file=None
+    ):
+        self.block_size = block_size
+        self.round_length = round_length
+        self.z_bias = get_z_bias(z_bias, efficient)
+        self.efficient = efficient
+        self.rng = np.random.default_rng(seed)
+        self.blocks = queue.Queue(maxsize=max_blocks)
+        self.stopped = threading.Event()
+        self.error = None
+        self.leftover = ""
+        # every round is appended to the log, so Bob can tail the same key
+        self.channel_log = ChannelLogWriter(public_channel_file) if public_channel_file else None
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                return self.blocks.get(timeout=0.1)
+            except queue.Empty:
+                # blocks sifted before a failure are still handed out first
+                if self.stopped.is_set():
+                    if self.error is not None:
+                        raise RuntimeError("Key stream stopped") from self.error
+                    raise StopIteration
+
+    def put(self, block):
+        # blocks while the queue is full, which is the backpressure
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce(self):
+        pending = ""
+        try:
+            while not self.stopped.is_set():
+                channel, sifted_key = run_protocol_round(self.round_length, self.z_bias, self.efficient, self.rng)
+                if self.channel_log:
+                    self.channel_log.append(channel)
+                pending += sifted_key
+
+                while len(pending) >= self.block_size:
+                    self.put(pending[:self.block_size])
+                    pending = pending[self.block_size:]
+        except Exception as error:
+            self.error = error
+        finally:
+            # consumers waiting in __next__ or take see the stop and the error
+            self.stopped.set()
+
+    def take(self, n_bits):
+        """Returns exactly n_bits key bits, spanning blocks as needed."""
+        while len(self.leftover) < n_bits:
+            self.leftover += next(self)
+
+        bits = self.leftover[:n_bits]
+        self.leftover = self.leftover[n_bits:]
+        return bits
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def generate_key_blocks(block_size=KEY_BLOCK_SIZE, **options):
+    """Yields sifted key blocks until the consumer stops iterating."""
+    with KeyStream(block_size, **options) as stream:
+        yield from stream
 
 
 # ============================
 # Bob (Receiver)
 # ============================
-def replicate_key_for_receiver(public_channel_file, verbose=False):
-    with open(public_channel_file, "r") as f:
-        public_data = json.load(f)
+def replicate_key_for_receiver(public_channel_file, verbose=False, offset_file=None, verifier=None):
+    if offset_file is not None or is_channel_log(public_channel_file):
+        return tail_key_for_receiver(public_channel_file, verbose, offset_file, verifier)
 
-    alice_bits  = public_data["simulated_alice_bits"]
-    alice_bases = public_data["alice_bases"]
-    bob_bases   = public_data["bob_bases"]
+    # binary channels are memory-mapped and sifted on the packed bases
+    channel = read_public_channel(public_channel_file)
 
     if verbose:
-        print_protocol_details(alice_bits, alice_bases, bob_bases)
+        print_protocol_details(*unpack_channel(channel))
 
-    sifted_key = "".join(
-        alice_bits[i]
-        for i in range(len(alice_bits))
-        if alice_bases[i] == bob_bases[i]
-    )
+    return sift_public_channel(channel)
 
-    return sifted_key
+
+def tail_key_for_receiver(channel_log_file, verbose=False, offset_file=None, verifier=None):
+    """
+    Sifts only the frames appended since the offset stored in offset_file
+    and moves the offset past them. Without an offset file the whole log
+    is sifted. With a verifier, frames Alice has not tagged yet wait for
+    a later call.
+    """
+    offset, next_sequence = load_channel_offset(offset_file) if offset_file else (0, 0)
+    sifted_blocks = []
+
+    for sequence, channel, offset in read_channel_frames(channel_log_file, offset, verifier):
+        if sequence != next_sequence:
+            raise ValueError(f"Public channel log jumped from frame {next_sequence} to {sequence}")
+        next_sequence += 1
+
+        if verbose:
+            print_protocol_details(*unpack_channel(channel))
+
+        sifted_blocks.append(sift_public_channel(channel))
+
+    if offset_file:
+        save_channel_offset(offset_file, offset, next_sequence)
+
+    return "".join(sifted_blocks)
 
 
 # ============================
 # QBER Calculation
 # ============================
+def get_wilson_interval(errors, test_size, confidence=0.95):
+    """Wilson score interval for the error rate, usable at 0 errors too."""
+    if not test_size:
+        return 0.0, 1.0
+
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    rate = errors / test_size
+    denominator = 1 + z * z / test_size
+    center = (rate + z * z / (2 * test_size)) / denominator
+    margin = z * sqrt(rate * (1 - rate) / test_size + z * z / (4 * test_size * test_size)) / denominator
+
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def estimate_qber(
+    alice_sifted_key,
+    bob_sifted_key,
+    test_fraction=QBER_TEST_FRACTION,
+    confidence=0.95,
+    rng=None
+):
+    """
+    Reveals a random test_fraction of the sifted key and returns the QBER,
+    its confidence interval and the key without the revealed bits.
+    """
+    sample = reveal_test_sample(
+        bits_to_array(alice_sifted_key),
+        bits_to_array(bob_sifted_key),
+        test_fraction,
+        rng
+    )
+    errors = sample["errors"]
+    test_size = sample["test_size"]
+
+    return {
+        "qber": errors / test_size,
+        "qber_interval": get_wilson_interval(errors, test_size, confidence),
+        "errors": errors,
+        "test_size": test_size,
+        "final_key": array_to_bit_string(sample["alice_bits"])
+    }
+
+
 def calculate_qber(
     alice_sifted_key,
     bob_sifted_key,
-    test_fraction=0.2
+    test_fraction=QBER_TEST_FRACTION
 ):
-    assert len(alice_sifted_key) == len(bob_sifted_key)
+    estimate = estimate_qber(alice_sifted_key, bob_sifted_key, test_fraction)
 
-    key_len = len(alice_sifted_key)
-    test_size = max(1, int(key_len * test_fraction))
+    return estimate["qber"], estimate["final_key"]
 
-    test_indices = random.sample(range(key_len), test_size)
 
-    errors = sum(
-        1
-        for i in test_indices
-        if alice_sifted_key[i] != bob_sifted_key[i]
-    )
+# ============================
+# Sequential QBER estimation
+# ============================
+class SequentialTest:
+    """
+    Wald's sequential probability ratio test of QBER = p0 against p1, whose
+    log-likelihood ratio carries over from one protocol round to the next.
+    A short round reveals only a few test bits, far fewer than either
+    bound needs, so a single test spans the rounds of a whole key block.
+    """
+
+    def __init__(
+        self,
+        p0=SPRT_P0,
+        p1=QBER_THRESHOLD,
+        alpha=SPRT_ALPHA,
+        beta=SPRT_BETA,
+        llr=0.0,
+        test_size=0,
+        errors=0,
+        decision=None
+    ):
+        assert 0 < p0 < p1 < 1
+
+        self.p1 = p1
+        self.error_step = log(p1 / p0)
+        self.match_step = log((1 - p1) / (1 - p0))
+        self.accept_bound = log(beta / (1 - alpha))
+        self.abort_bound = log((1 - beta) / alpha)
+
+        self.llr = llr
+        self.test_size = test_size
+        self.errors = errors
+        self.decision = decision
+
+    def add(self, mismatches):
+        """
+        Feeds test bits in order (True where Alice and Bob differ) and
+        returns how many were used: only the bits up to the first bound
+        crossing count as revealed.
+        """
+        if self.decision is not None or not len(mismatches):
+            return 0
+
+        path = self.llr + np.cumsum(np.where(mismatches, self.error_step, self.match_step))
+        crossed = np.flatnonzero((path <= self.accept_bound) | (path >= self.abort_bound))
+        revealed = crossed[0] + 1 if len(crossed) else len(mismatches)
+
+        self.llr = float(path[revealed - 1])
+        self.test_size += int(revealed)
+        self.errors += int(np.count_nonzero(mismatches[:revealed]))
+        if len(crossed):
+            self.decision = SPRT_ABORT if self.llr >= self.abort_bound else SPRT_ACCEPT
+
+        return int(revealed)
+
+    def qber(self):
+        return self.errors / self.test_size if self.test_size else 0.0
+
+    def finish(self):
+        """Decides on the estimated QBER when the test bits ran out before a bound."""
+        # with no test bits at all nothing bounds Eve's knowledge
+        if self.decision is None:
+            self.decision = SPRT_ABORT if not self.test_size or self.qber() > self.p1 else SPRT_ACCEPT
+
+        return self.decision
+
+    def as_dict(self):
+        return {"llr": self.llr, "test_size": self.test_size, "errors": self.errors, "decision": self.decision}
+
+
+def sequential_estimate_qber(
+    alice_sifted_key,
+    bob_sifted_key,
+    max_test_fraction=QBER_TEST_FRACTION,
+    p0=SPRT_P0,
+    p1=QBER_THRESHOLD,
+    alpha=SPRT_ALPHA,
+    beta=SPRT_BETA,
+    batch_size=SPRT_BATCH_SIZE,
+    confidence=0.95,
+    rng=None,
+    test=None
+):
+    """
+    Runs the SPRT on test bits revealed batch_size at a time and stops as
+    soon as either hypothesis is accepted, so an eavesdropped channel is
+    aborted after a few dozen bits and an honest one does not spend the
+    whole test fraction.
+
+    On its own, a key whose max_test_fraction runs out first is decided
+    on the estimated QBER. With test (a SequentialTest shared by several
+    rounds) the test goes on in the next round instead and the decision
+    is SPRT_CONTINUE; a test that already decided reveals no more bits.
+    """
+    assert len(alice_sifted_key) == len(bob_sifted_key)
 
-    qber = errors / test_size
+    shared = test is not None
+    test = test or SequentialTest(p0, p1, alpha, beta)
+    rng = rng or np.random.default_rng()
+    alice_bits = bits_to_array(alice_sifted_key)
+    bob_bits = bits_to_array(bob_sifted_key)
+
+    key_len = len(alice_bits)
+    max_test_size = min(key_len, max(1, int(key_len * max_test_fraction)))
+    test_order = rng.permutation(key_len)[:max_test_size]
+
+    test_size = 0
+    while test.decision is None and test_size < max_test_size:
+        batch = test_order[test_size:test_size + batch_size]
+        test_size += test.add(alice_bits[batch] != bob_bits[batch])
+
+    decision = test.decision or (SPRT_CONTINUE if shared else test.finish())
+
+    keep_mask = np.ones(key_len, dtype=bool)
+    keep_mask[test_order[:test_size]] = False
+
+    return {
+        "decision": decision,
+        "qber": test.qber(),
+        "qber_interval": get_wilson_interval(test.errors, test.test_size, confidence),
+        "errors": test.errors,
+        "test_size": test.test_size,
+        "final_key": array_to_bit_string(alice_bits[keep_mask])
+    }
 
-    final_key = "".join(
-        alice_sifted_key[i]
-        for i in range(key_len)
-        if i not in test_indices
-    )
 
-    return qber, final_key
+# ============================
+# Final keys
+# ============================
+def generate_final_key(
+    key_length=128,
+    z_bias=None,
+    efficient=False,
+    rng=None,
+    channel_log=None,
+    reconciliation=CASCADE_RECONCILIATION,
+    confirm=False,
+    test=None
+):
+    """
+    One protocol run followed by sequential QBER estimation and Cascade or
+    LDPC reconciliation. The round is appended to channel_log (a
+    ChannelLogWriter) when one is given. Key confirmation is left to the
+    caller, once per block of runs: its tag costs some 40 bits, most of a
+    short run's key, so confirm=True is only worth it on long ones. test
+    continues a SequentialTest over runs (see sequential_estimate_qber).
+    """
+    z_bias = get_z_bias(z_bias, efficient)
+    rng = rng or np.random.default_rng()
+    channel, sifted_key = run_protocol_round(key_length, z_bias, efficient, rng)
+
+    if channel_log:
+        channel_log.append(channel)
+
+    # Bob's sifted key is simulated as identical to Alice's
+    estimate = sequential_estimate_qber(sifted_key, sifted_key, rng=rng, test=test)
+    if estimate["decision"] == SPRT_ABORT:
+        return estimate
+
+    # the parities or syndromes disclosed are counted against the key
+    final_bits = bits_to_array(estimate["final_key"])
+    if reconciliation == LDPC_RECONCILIATION:
+        result = ldpc_reconcile(final_bits, final_bits, estimate["qber"])
+        # a frame belief propagation did not converge on still holds errors:
+        # the key is reconciled again with Cascade, on top of the syndromes
+        # already disclosed
+        if result["failed_frames"]:
+            ldpc_leak = result["leaked_bits"]
+            result = cascade(final_bits, final_bits, estimate["qber"], seed=rng)
+            result["leaked_bits"] += ldpc_leak
+    elif reconciliation == CASCADE_RECONCILIATION:
+        result = cascade(final_bits, final_bits, estimate["qber"], seed=rng)
+    else:
+        raise ValueError(f"Unknown reconciliation method: {reconciliation}")
+
+    # final_key stays Alice's; Bob's is kept apart so key confirmation
+    # compares the two keys rather than one with itself
+    estimate["receiver_key"] = array_to_bit_string(result["key"])
+    estimate["leaked_bits"] = result["leaked_bits"]
+    estimate["corrected_errors"] = result["corrected_errors"]
+
+    # Alice and Bob compare short hashes of the reconciled keys, not key bits
+    if confirm:
+        confirmation = confirm_keys(np.packbits(final_bits), np.packbits(result["key"]), seed=rng)
+        estimate["leaked_bits"] += confirmation["leaked_bits"]
+        if not confirmation["confirmed"]:
+            estimate["decision"] = CONFIRMATION_FAILED
+
+    return estimate
@@ -7,4 +7,50 @@ STATE_1 = "|1>"
 STATE_PLUS = "|+>"
 STATE_MINUS = "|->"
 QBER_TEST_FRACTION = 0.1   # 10% bits revealed for QBER
-QBER_THRESHOLD = 0.11     # 11% abort threshold (BB84 standard)
\ No newline at end of file
+QBER_THRESHOLD = 0.11     # 11% abort threshold (BB84 standard)
+EFFICIENT_Z_BIAS = 0.9     # Z basis probability in efficient BB84
+KEY_BLOCK_SIZE = 1024      # sifted bits per streamed key block
+KEY_STREAM_DEPTH = 8       # key blocks buffered ahead of the consumer
+JSON_CHANNEL = "json"       # indented JSON public channel, for debugging
+BINARY_CHANNEL = "binary"   # header + bit-packed bases, memory-mapped by Bob
+LOG_CHANNEL = "log"         # append-only log of framed rounds, tailed by Bob
+SPRT_P0 = 0.03             # QBER of an honest channel, the SPRT null hypothesis
+SPRT_ALPHA = 0.01          # probability of aborting an honest channel
+SPRT_BETA = 0.01           # probability of accepting a channel at QBER_THRESHOLD
+SPRT_BATCH_SIZE = 16       # test bits revealed per estimation round
+SPRT_ACCEPT = "accept"
+SPRT_ABORT = "abort"
+SPRT_CONTINUE = "continue"  # no decision yet: the test goes on in the next run
+OTP_CHUNK_SIZE = 1 << 20    # bytes XORed per chunk when streaming files
+KEY_POOL_ROUND_LENGTH = 128 # qubits per BB84 run that fills the key pool
+KEY_POOL_MAX_RUNS = 1000    # runs per fill before giving up (e.g. Eve on the line)
+CASCADE_PASSES = 4          # Cascade passes, block size doubling each pass
+CASCADE_MIN_BLOCK_SIZE = 4  # smallest first-pass Cascade block
+CASCADE_RECONCILIATION = "cascade"  # interactive, parities traded in passes
+LDPC_RECONCILIATION = "ldpc"        # one-way, one syndrome per frame: for long keys
+LDPC_FRAME_LENGTH = 1 << 14  # key bits per LDPC codeword
+LDPC_COLUMN_WEIGHT = 3      # parity checks every key bit takes part in
+LDPC_CODE_SEED = 84         # shared seed both sides build the matrices from
+LDPC_MAX_ITERATIONS = 50    # belief propagation iterations before a frame fails
+LDPC_MIN_SUM_SCALE = 0.8    # normalisation of the min-sum check messages
+# code rate -> highest QBER at which it decoded every one of 32 test
+# frames of LDPC_FRAME_LENGTH bits, less a 0.001 margin
+LDPC_RATES = {
+    0.9: 0.004,
+    0.85: 0.008,
+    0.8: 0.015,
+    0.75: 0.021,
+    0.7: 0.031,
+    0.65: 0.037,
+    0.6: 0.051,
+    0.5: 0.075,
+    0.4: 0.103,
+    0.3: 0.133
+}
+PRIVACY_EPSILON = 1e-10     # distance of the amplified key from a uniform one
+PRIVACY_BLOCK_LENGTH = 1 << 12  # reconciled bits the key pool amplifies at once
+PRIVACY_QBER_CONFIDENCE = 0.999  # confidence of the QBER upper bound a block is amplified with
+AUTH_HASH_LANES = 1 << 12     # message words hashed side by side (a power of 16)
+AUTH_SLICE_SIZE = 1 << 9       # key pool bytes per authentication slice: hash key + 63 tag pads
+CONFIRMATION_FAILURE_PROBABILITY = 1e-10  # chance two different reconciled keys pass key confirmation
+CONFIRMATION_FAILED = "unconfirmed"        # decision of a run whose keys failed key confirmation
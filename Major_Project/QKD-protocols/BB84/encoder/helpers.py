@@ -1,7 +1,9 @@
 from qiskit import QuantumCircuit, transpile
 from qiskit_aer import AerSimulator
 from constants import *
-import random
+import codecs
+import numpy as np
+import struct
 
 # ANSI color codes for better terminal output
 class colors:
@@ -23,16 +25,58 @@ def get_random_sequence_of_bits(size):
     result = job.result()
     str_sequence = result.get_memory(compiled_circuit)[0]
     return list(str_sequence)
-def get_random_sequence_of_bases(size, z_bias=0.5):
+def get_random_sequence_of_bases(size, z_bias=0.5, rng=None):
     """
     Generates a random sequence of bases with controllable bias.
     z_bias = probability of choosing Z basis
     """
-    bases = [
-        Z_BASE if random.random() < z_bias else X_BASE
-        for _ in range(size)
-    ]
-    return bases
+    return mask_to_bases(get_biased_bases_mask(size, z_bias, rng))
+
+def get_biased_bases_mask(shape, z_bias=0.5, rng=None):
+    """
+    Draws bases in bulk as a boolean mask (True = X basis).
+    shape=(2, n) gives Alice's and Bob's masks from a single draw.
+    """
+    rng = rng or np.random.default_rng()
+    return rng.random(shape) >= z_bias
+
+def mask_to_bases(mask):
+    """Converts a basis mask back to a list of Z/X bases."""
+    return np.where(mask, X_BASE, Z_BASE).tolist()
+
+def bases_to_mask(bases):
+    """Converts a list of Z/X bases to a basis mask."""
+    return np.asarray(bases) == X_BASE
+
+def get_sift_mask(alice_mask, bob_mask, z_bias=0.5, efficient=False):
+    """
+    Positions kept after sifting.
+    In efficient BB84 only matches in the dominant basis are kept, so the
+    sift ratio is max(z_bias, 1 - z_bias)^2 instead of 1/2.
+    """
+    sift_mask = alice_mask == bob_mask
+    if efficient:
+        dominant_is_x = z_bias < 0.5
+        sift_mask &= alice_mask == dominant_is_x
+    return sift_mask
+
+def get_packed_sift_mask(alice_packed, bob_packed, length, z_bias=0.5, efficient=False):
+    """Same as get_sift_mask, on basis masks packed eight per byte."""
+    sift_packed = ~(alice_packed ^ bob_packed)
+    if efficient:
+        dominant_is_x = z_bias < 0.5
+        sift_packed &= alice_packed if dominant_is_x else ~alice_packed
+    return np.unpackbits(sift_packed, count=length).view(bool)
+
+def bits_to_array(bits):
+    """Converts a list or string of 0/1 characters to a uint8 array."""
+    if isinstance(bits, str):
+        return np.frombuffer(bits.encode(), dtype=np.uint8) - ord(BIT_0)
+    return (np.asarray(bits) == BIT_1).astype(np.uint8)
+
+def array_to_bit_string(array):
+    """Converts a 0/1 array to a bit string without a Python loop."""
+    return (np.asarray(array, dtype=np.uint8) + ord(BIT_0)).tobytes().decode()
 
 
 def get_state(bit, base):
@@ -100,27 +144,109 @@ def print_protocol_details(alice_bits, alice_bases, bob_bases):
 # --- Encryption Helper Functions (unchanged) ---
 
 def text_to_binary(text):
-    """Converts a string of text to a binary string."""
-    return ''.join(format(ord(char), '08b') for char in text)
+    """Converts a string of text to a binary string of its UTF-8 bytes."""
+    return bytes_to_bits(text.encode("utf-8"))
 
 def binary_to_text(binary_string):
-    """Converts a binary string back to text."""
+    """Converts a binary string of UTF-8 bytes back to text."""
     if len(binary_string) % 8 != 0:
         padding = 8 - (len(binary_string) % 8)
         binary_string = '0' * padding + binary_string
-    chars = [binary_string[i:i+8] for i in range(0, len(binary_string), 8)]
-    text = ''.join(chr(int(char, 2)) for char in chars)
-    return text
+    return bits_to_bytes(binary_string).decode("utf-8")
 
 def xor_encrypt_decrypt(binary_input, binary_key):
     """Encrypts or decrypts a binary string using a binary key with XOR."""
-    key_length = len(binary_key)
-    if key_length == 0:
+    if len(binary_key) == 0:
         raise ValueError("Encryption key cannot be empty.")
-    result = []
-    for i in range(len(binary_input)):
-        input_bit = int(binary_input[i])
-        key_bit = int(binary_key[i % key_length])
-        xor_result = input_bit ^ key_bit
-        result.append(str(xor_result))
-    return "".join(result)
\ No newline at end of file
+    input_bits = bits_to_array(binary_input)
+    key_bits = np.resize(bits_to_array(binary_key), len(input_bits))
+    return array_to_bit_string(input_bits ^ key_bits)
+
+# --- One-time pad on bytes ---
+
+# ciphertext file: magic, payload length in bytes, offset of the pad in
+# the key pool, then the XORed payload
+CIPHERTEXT_MAGIC = b"QOTP"
+CIPHERTEXT_HEADER = struct.Struct("<4sQQ")
+
+def bits_to_bytes(binary_string):
+    """Packs a bit string into bytes, first bit as the most significant."""
+    return np.packbits(bits_to_array(binary_string)).tobytes()
+
+def bytes_to_bits(data):
+    """Unpacks bytes into a bit string."""
+    return array_to_bit_string(np.unpackbits(np.frombuffer(data, dtype=np.uint8)))
+
+def xor_bytes(data, key):
+    """
+    XORs a bytes-like buffer (bytes, memoryview, uint8 array) with the
+    start of the key. A one-time pad key is never repeated, so it must be
+    at least as long as the data.
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    key = np.frombuffer(key, dtype=np.uint8)
+    if len(key) < len(data):
+        raise ValueError("One-time pad key is shorter than the data.")
+    return np.bitwise_xor(data, key[:len(data)])
+
+def read_ciphertext_header(f):
+    magic, length, key_offset = CIPHERTEXT_HEADER.unpack(f.read(CIPHERTEXT_HEADER.size))
+    if magic != CIPHERTEXT_MAGIC:
+        raise ValueError(f"'{f.name}' is not a ciphertext file.")
+    return length, key_offset
+
+def get_ciphertext_info(ciphertext_file):
+    """Returns (payload length, key pool offset) from a ciphertext file header."""
+    with open(ciphertext_file, "rb") as f:
+        return read_ciphertext_header(f)
+
+# --- UTF-8 chunked codec ---
+
+def iter_text_chunks(text, chunk_size=OTP_CHUNK_SIZE):
+    """Yields the UTF-8 encoding of text, chunk_size characters at a time."""
+    for start in range(0, len(text), chunk_size):
+        yield text[start:start + chunk_size].encode("utf-8")
+
+def get_utf8_length(text, chunk_size=OTP_CHUNK_SIZE):
+    """Number of bytes text takes in UTF-8, without encoding it all at once."""
+    return sum(len(chunk) for chunk in iter_text_chunks(text, chunk_size))
+
+def decode_text_chunks(chunks):
+    """
+    Decodes UTF-8 byte chunks back to text. The incremental decoder keeps
+    a character split across two chunks until its last byte arrives.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    text = [decoder.decode(chunk) for chunk in chunks]
+    text.append(decoder.decode(b"", final=True))
+    return "".join(text)
+
+def encrypt_chunks_to_file(chunks, ciphertext_file, key, key_offset=0):
+    """
+    Encrypts byte chunks with consecutive slices of the pad into a
+    ciphertext file. The length header is filled in once all chunks are
+    written, so the payload never has to be in memory at once.
+    """
+    key = np.frombuffer(key, dtype=np.uint8)
+    length = 0
+    with open(ciphertext_file, "wb") as f:
+        f.write(CIPHERTEXT_HEADER.pack(CIPHERTEXT_MAGIC, 0, key_offset))
+        for chunk in chunks:
+            f.write(xor_bytes(chunk, key[length:]).tobytes())
+            length += len(chunk)
+        f.seek(0)
+        f.write(CIPHERTEXT_HEADER.pack(CIPHERTEXT_MAGIC, length, key_offset))
+    return length
+
+def iter_decrypted_chunks(ciphertext_file, key, chunk_size=OTP_CHUNK_SIZE):
+    """Yields the decrypted payload of a ciphertext file, chunk_size bytes at a time."""
+    key = np.frombuffer(key, dtype=np.uint8)
+    with open(ciphertext_file, "rb") as f:
+        length, _ = read_ciphertext_header(f)
+        offset = 0
+        while offset < length:
+            chunk = f.read(min(chunk_size, length - offset))
+            if not chunk:
+                raise EOFError(f"Expected {length} bytes, got {offset}.")
+            yield xor_bytes(chunk, key[offset:]).tobytes()
+            offset += len(chunk)
@@ -0,0 +1,135 @@
+import time
+import numpy as np
+from math import ceil, log2
+from authentication import get_multiplication_tables, multiply_words, polynomial_hash
+from constants import CONFIRMATION_FAILURE_PROBABILITY
+
+
+# ============================
+# Tag length
+# ============================
+def get_confirmation_size(n_words, failure_probability=CONFIRMATION_FAILURE_PROBABILITY):
+    """
+    Returns (number of 64-bit hashes, tag bits) so that two different keys
+    of n_words words get the same tag with probability at most
+    failure_probability. One polynomial hash truncated to t bits collides
+    with probability at most n_words / 2^t, and h independent hashes
+    multiply those bounds.
+    """
+    n_hashes = 1
+    while True:
+        tag_bits = ceil(n_hashes * log2(max(n_words, 1)) + log2(1 / failure_probability))
+        if tag_bits <= 64 * n_hashes:
+            return n_hashes, tag_bits
+        n_hashes += 1
+
+
+# ============================
+# Block tags
+# ============================
+def packed_blocks_to_words(packed_blocks):
+    """Each row of packed key bytes as little-endian 64-bit words, zero-padded."""
+    n_blocks, n_bytes = packed_blocks.shape
+    words = np.zeros((n_blocks, -(-n_bytes // 8) * 8), dtype=np.uint8)
+    words[:, :n_bytes] = packed_blocks
+
+    return words.view("<u8")
+
+
+def get_confirmation_tags(packed_blocks, hash_keys, tag_bits):
+    """
+    polynomial_hash of every block's bytes under every hash key, as an
+    (n_blocks, len(hash_keys)) array with the last hash cut to the leftover
+    bits. Many short blocks go through Horner's rule side by side, one
+    table multiplication per word and the length word last, as
+    polynomial_hash ends; a few long ones are hashed one by one, which
+    folds their words in lanes and reuses the cached tables of a key.
+    """
+    n_blocks, n_bytes = packed_blocks.shape
+    tags = np.zeros((n_blocks, len(hash_keys)), dtype=np.uint64)
+
+    if n_blocks >= n_bytes // 8:
+        words = packed_blocks_to_words(packed_blocks)
+        length_word = np.full(n_blocks, n_bytes, dtype=np.uint64)
+
+        for i, table in enumerate(get_multiplication_tables(hash_keys)):
+            accumulators = np.zeros(n_blocks, dtype=np.uint64)
+            for column in [*words.T, length_word]:
+                accumulators = multiply_words(accumulators ^ column, table)
+            tags[:, i] = accumulators
+    else:
+        for block, block_bytes in enumerate(packed_blocks):
+            tags[block] = [polynomial_hash(block_bytes.tobytes(), hash_key) for hash_key in hash_keys]
+
+    tags[:, -1] &= np.uint64((1 << (tag_bits - 64 * (len(hash_keys) - 1))) - 1)
+
+    return tags
+
+
+def confirm_keys(alice_packed, bob_packed, seed=None, failure_probability=CONFIRMATION_FAILURE_PROBABILITY):
+    """
+    Key confirmation on bit-packed keys: both sides hash their reconciled
+    key with hash keys drawn from a public seed and only the tags are
+    compared. The seed has to be drawn after the keys are fixed, afresh
+    for every confirmation, or Eve could pick errors the hashes miss. A
+    1-D key is one block, the rows of a 2-D array are blocks confirmed
+    independently. The tags are public, so their bits count as leaked.
+    """
+    alice_blocks = np.atleast_2d(np.asarray(alice_packed, dtype=np.uint8))
+    bob_blocks = np.atleast_2d(np.asarray(bob_packed, dtype=np.uint8))
+    n_blocks, n_bytes = alice_blocks.shape
+
+    # the length word polynomial_hash appends counts as a word too
+    n_hashes, tag_bits = get_confirmation_size(-(-n_bytes // 8) + 1, failure_probability)
+    rng = np.random.default_rng(seed)
+    hash_keys = [int(key) for key in rng.integers(1, 1 << 64, n_hashes, dtype=np.uint64)]
+
+    alice_tags = get_confirmation_tags(alice_blocks, hash_keys, tag_bits)
+    bob_tags = get_confirmation_tags(bob_blocks, hash_keys, tag_bits)
+    confirmed = np.all(alice_tags == bob_tags, axis=1)
+
+    return {
+        "confirmed": bool(confirmed.all()),
+        "confirmed_blocks": confirmed,
+        "tag_bits": tag_bits,
+        "leaked_bits": tag_bits * n_blocks
+    }
+
+
+# ============================
+# Speed check
+# ============================
+def benchmark_key_confirmation(n_blocks=10**4, block_bits=1024, failure_probability=CONFIRMATION_FAILURE_PROBABILITY):
+    rng = np.random.default_rng()
+    alice_blocks = rng.integers(0, 256, (n_blocks, block_bits // 8), dtype=np.uint8)
+    bob_blocks = alice_blocks.copy()
+
+    # the side-by-side path against polynomial_hash of each block
+    hash_key = int(rng.integers(1, 1 << 63))
+    tags = get_confirmation_tags(alice_blocks[:200], [hash_key], 64)
+    assert all(int(tags[i, 0]) == polynomial_hash(alice_blocks[i].tobytes(), hash_key) for i in range(200))
+
+    # one flipped bit in every tenth block
+    flipped = np.arange(0, n_blocks, 10)
+    bob_blocks[flipped, rng.integers(0, block_bits // 8, len(flipped))] ^= 1
+
+    start = time.perf_counter()
+    result = confirm_keys(alice_blocks, bob_blocks, failure_probability=failure_probability)
+    elapsed = time.perf_counter() - start
+
+    assert np.array_equal(np.flatnonzero(~result["confirmed_blocks"]), flipped)
+    print(f"{n_blocks:,} blocks of {block_bits} bits, {result['tag_bits']}-bit tags: "
+          f"{elapsed * 1e6 / n_blocks:.2f} us per block, {len(flipped):,} mismatches found")
+
+    # one key pool block at a time, each under a fresh seed
+    block = rng.integers(0, 256, 1 << 9, dtype=np.uint8)
+
+    start = time.perf_counter()
+    confirm_keys(block, block, seed=rng)
+    elapsed = time.perf_counter() - start
+
+    print(f"one block of {8 * len(block)} bits with a fresh seed: {elapsed * 1e6:.0f} us")
+
+
+if __name__ == "__main__":
+    benchmark_key_confirmation()
@@ -0,0 +1,342 @@
+import json
+import os
+import time
+import numpy as np
+from authentication import Authenticator
+from bb84_engine import generate_final_key, get_wilson_interval, SequentialTest
+from constants import (
+    KEY_POOL_ROUND_LENGTH, SPRT_ABORT, CASCADE_RECONCILIATION,
+    PRIVACY_BLOCK_LENGTH, PRIVACY_QBER_CONFIDENCE, AUTH_SLICE_SIZE
+)
+from helpers import bits_to_bytes, bits_to_array, array_to_bit_string
+from key_confirmation import confirm_keys
+from privacy_amplification import amplify_privacy
+from public_channel import ChannelLogWriter
+
+
+# ============================
+# Key pool
+# ============================
+class KeyPool:
+    """
+    Final key bytes accumulated from repeated BB84 runs in pool_file.
+    Reconciled bits wait in the state until PRIVACY_BLOCK_LENGTH of them
+    can be privacy-amplified together, since the security margin of a
+    single short run would swallow all of its key. The runs of a block
+    also share one sequential QBER test, which a single run is too short
+    to decide; when it aborts, the whole block is dropped.
+
+    Every byte is handed out once: the consumed offset is saved in
+    pool_file + ".state" before the key is returned, so a crash can skip
+    key but never reuse it.
+
+    A slice of AUTH_SLICE_SIZE bytes is set aside to authenticate the
+    public channel log. The first slice is the pre-shared key, later ones
+    are cut from key below authenticated_end, i.e. from runs a tag already
+    covers, and always before the runs of a fill start.
+    """
+
+    def __init__(
+        self,
+        pool_file,
+        round_length=KEY_POOL_ROUND_LENGTH,
+        public_channel_file=None,
+        max_runs=None,
+        reconciliation=CASCADE_RECONCILIATION,
+        preshared_key=None
+    ):
+        self.pool_file = pool_file
+        self.state_file = pool_file + ".state"
+        self.round_length = round_length
+        self.max_runs = max_runs
+        self.reconciliation = reconciliation
+        self.state = self.load_state()
+
+        # rates are measured over this session only
+        self.opened_at = time.monotonic()
+        self.fill_seconds = 0.0
+        self.session_added = 0
+        self.session_consumed = 0
+
+        if preshared_key is not None and not self.state["auth_end"]:
+            self.bootstrap_authentication(preshared_key)
+
+        self.authenticator = Authenticator(self) if self.state["auth_end"] else None
+        self.channel_log = ChannelLogWriter(public_channel_file, self.authenticator) if public_channel_file else None
+
+    def load_state(self):
+        state = {
+            "added": 0,
+            "consumed": 0,
+            "pending_bits": "",
+            "runs": 0,
+            "aborted_runs": 0,
+            "aborted_blocks": 0,
+            "leaked_bits": 0,
+            "raw_bits": "",
+            "receiver_raw_bits": "",
+            "raw_leaked_bits": 0,
+            "raw_errors": 0,
+            "sequential_test": {},
+            "amplified_bits": 0,
+            "secret_bits": 0,
+            "unconfirmed_blocks": 0,
+            "auth_key_offset": 0,
+            "auth_next": 0,
+            "auth_end": 0,
+            "authenticated_end": 0
+        }
+
+        if os.path.exists(self.state_file):
+            with open(self.state_file, "r") as f:
+                state.update(json.load(f))
+
+        # bytes written after the last saved state were never accounted for
+        if os.path.exists(self.pool_file) and os.path.getsize(self.pool_file) > state["added"]:
+            os.truncate(self.pool_file, state["added"])
+
+        return state
+
+    def save_state(self):
+        temporary_file = self.state_file + ".tmp"
+        with open(temporary_file, "w") as f:
+            json.dump(self.state, f)
+
+        os.replace(temporary_file, self.state_file)
+
+    def depth(self):
+        """Key bytes available to take."""
+        return self.state["added"] - self.state["consumed"]
+
+    def add_key(self, final_key):
+        # bits short of a whole byte wait for the next run
+        bits = self.state["pending_bits"] + final_key
+        whole_bits = len(bits) // 8 * 8
+
+        with open(self.pool_file, "ab") as f:
+            f.write(bits_to_bytes(bits[:whole_bits]))
+
+        self.state["added"] += whole_bits // 8
+        self.state["pending_bits"] = bits[whole_bits:]
+        self.session_added += whole_bits // 8
+        self.save_state()
+
+    def discard_raw_block(self):
+        # the next block starts with an empty sequential test
+        self.state["raw_bits"] = ""
+        self.state["receiver_raw_bits"] = ""
+        self.state["raw_leaked_bits"] = 0
+        self.state["raw_errors"] = 0
+        self.state["sequential_test"] = {}
+
+    def add_reconciled_key(self, reconciled_key, receiver_key, corrected_errors, leaked_bits):
+        self.state["raw_bits"] += reconciled_key
+        self.state["receiver_raw_bits"] += receiver_key
+        self.state["raw_leaked_bits"] += leaked_bits
+        self.state["raw_errors"] += corrected_errors
+
+        raw_length = len(self.state["raw_bits"])
+        if raw_length < PRIVACY_BLOCK_LENGTH:
+            self.save_state()
+            return
+
+        # a block that ran out of test bits is decided on its estimated QBER
+        test = SequentialTest(**self.state["sequential_test"])
+        decision = test.finish()
+        if decision == SPRT_ABORT:
+            self.state["aborted_blocks"] += 1
+            self.discard_raw_block()
+            self.save_state()
+            return
+
+        # one confirmation tag per block instead of one per short run, under
+        # a public seed drawn only now, once both keys of the block are fixed
+        raw_bits = bits_to_array(self.state["raw_bits"])
+        receiver_bits = bits_to_array(self.state["receiver_raw_bits"])
+        seed = int(np.random.default_rng().integers(1 << 63))
+        confirmation = confirm_keys(np.packbits(raw_bits), np.packbits(receiver_bits), seed=seed)
+        leaked_bits = self.state["raw_leaked_bits"] + confirmation["leaked_bits"]
+        self.state["leaked_bits"] += confirmation["leaked_bits"]
+
+        # the SPRT stops on the first few dozen test bits that look clean, so
+        # the block's QBER is bounded from the errors reconciliation actually
+        # corrected as well, and from above rather than by its point estimate
+        errors = self.state["raw_errors"] + test.errors
+        qber = get_wilson_interval(errors, raw_length + test.test_size, PRIVACY_QBER_CONFIDENCE)[1]
+
+        # the Toeplitz seed is public; Bob would receive it with the block
+        result = amplify_privacy(raw_bits, qber, leaked_bits)
+        self.state["amplified_bits"] += raw_length
+        self.discard_raw_block()
+
+        if not confirmation["confirmed"]:
+            self.state["unconfirmed_blocks"] += 1
+            self.save_state()
+            return
+
+        self.state["secret_bits"] += result["secret_length"]
+        self.add_key(array_to_bit_string(result["key"]))
+
+    # ============================
+    # Authentication slice
+    # ============================
+    def bootstrap_authentication(self, preshared_key):
+        """Makes preshared_key the first authentication slice."""
+        # key pooled before authentication was switched on came from runs
+        # nobody authenticated, so it is skipped rather than cut into a slice
+        offset = self.state["added"]
+        with open(self.pool_file, "ab") as f:
+            f.write(preshared_key)
+
+        # the pre-shared bytes count as handed out, they are never a pad
+        self.state["added"] = self.state["consumed"] = offset + len(preshared_key)
+        self.state["pending_bits"] = ""
+        self.discard_raw_block()
+        self.state["auth_key_offset"] = offset
+        self.state["auth_next"] = offset + 8
+        self.state["auth_end"] = offset + len(preshared_key)
+        self.state["authenticated_end"] = self.state["added"]
+        self.save_state()
+
+    def reserve_authentication_slice(self):
+        # only key of runs a tag already covers may authenticate later runs
+        offset = self.state["consumed"]
+        authenticated = max(0, self.state["authenticated_end"] - offset)
+        if authenticated < AUTH_SLICE_SIZE:
+            raise RuntimeError(f"Key pool holds {authenticated} authenticated bytes, too few for a {AUTH_SLICE_SIZE} byte authentication slice.")
+
+        # the first 8 bytes are the hash key, the rest one-time pads for tags
+        self.state["consumed"] += AUTH_SLICE_SIZE
+        self.state["auth_key_offset"] = offset
+        self.state["auth_next"] = offset + 8
+        self.state["auth_end"] = offset + AUTH_SLICE_SIZE
+        self.session_consumed += AUTH_SLICE_SIZE
+        self.save_state()
+
+    def authentication_pads_left(self):
+        return (self.state["auth_end"] - self.state["auth_next"]) // 8
+
+    def take_authentication_pad(self):
+        """Returns (hash key offset, hash key, pad offset, pad) for the next tag."""
+        # a slice cut here could hold key of the very runs it is to authenticate
+        if not self.authentication_pads_left():
+            raise RuntimeError("No authentication pads left: the next slice is reserved when a fill starts.")
+
+        key_offset = self.state["auth_key_offset"]
+        pad_offset = self.state["auth_next"]
+        self.state["auth_next"] += 8
+        self.save_state()
+
+        hash_key, pad = self.read_authentication_pad(key_offset, pad_offset)
+        return key_offset, hash_key, pad_offset, pad
+
+    def read_authentication_pad(self, key_offset, pad_offset):
+        """(hash key, pad) as integers, e.g. for the receiver to check a tag."""
+        if pad_offset <= key_offset:
+            raise ValueError(f"Authentication pad at {pad_offset} overlaps the hash key at {key_offset}.")
+
+        hash_key = int.from_bytes(self.read(key_offset, 8), "little")
+        pad = int.from_bytes(self.read(pad_offset, 8), "little")
+
+        return hash_key, pad
+
+    def fill(self, n_bytes):
+        """Runs the protocol until at least n_bytes are available."""
+        started_at = time.monotonic()
+        runs = 0
+        aborted_runs = 0
+        aborted_blocks = self.state["aborted_blocks"]
+
+        # the next slice is cut before any run, from key that is already
+        # authenticated; when this fill's tag takes the last pad, the fill
+        # also makes the key the next one cuts its slice from
+        if self.channel_log and self.authenticator:
+            if not self.authentication_pads_left():
+                self.reserve_authentication_slice()
+            if self.authentication_pads_left() == 1:
+                n_bytes += AUTH_SLICE_SIZE
+
+        try:
+            while self.depth() < n_bytes:
+                if self.max_runs is not None and runs >= self.max_runs:
+                    aborted_blocks = self.state["aborted_blocks"] - aborted_blocks
+                    raise RuntimeError(
+                        f"Key pool holds {self.depth()} of {n_bytes} bytes after {runs} runs "
+                        f"({aborted_runs} runs and {aborted_blocks} blocks aborted on QBER)."
+                    )
+                runs += 1
+
+                test = SequentialTest(**self.state["sequential_test"])
+                estimate = generate_final_key(
+                    self.round_length,
+                    channel_log=self.channel_log,
+                    reconciliation=self.reconciliation,
+                    confirm=False,
+                    test=test
+                )
+                self.state["runs"] += 1
+                self.state["sequential_test"] = test.as_dict()
+
+                if estimate["decision"] == SPRT_ABORT:
+                    self.state["aborted_runs"] += 1
+                    aborted_runs += 1
+                    self.discard_raw_block()
+                    self.save_state()
+                    continue
+
+                self.state["leaked_bits"] += estimate["leaked_bits"]
+                self.add_reconciled_key(
+                    estimate["final_key"],
+                    estimate["receiver_key"],
+                    estimate["corrected_errors"],
+                    estimate["leaked_bits"]
+                )
+
+            # one tag covers every frame this fill appended, and with them
+            # the key of all runs so far
+            if self.channel_log and self.authenticator:
+                self.channel_log.append_tag()
+                self.state["authenticated_end"] = self.state["added"]
+                self.save_state()
+        finally:
+            self.fill_seconds += time.monotonic() - started_at
+
+    def take(self, n_bytes):
+        """Returns (offset, key) for the next n_bytes unused key bytes."""
+        self.fill(n_bytes)
+
+        offset = self.state["consumed"]
+        self.state["consumed"] += n_bytes
+        self.save_state()
+        self.session_consumed += n_bytes
+
+        return offset, self.read(offset, n_bytes)
+
+    def read(self, offset, n_bytes):
+        """Key bytes of a range handed out earlier, e.g. for the receiver."""
+        if offset + n_bytes > self.state["consumed"]:
+            raise ValueError(f"Key bytes {offset}-{offset + n_bytes} have not been handed out.")
+
+        with open(self.pool_file, "rb") as f:
+            f.seek(offset)
+            return f.read(n_bytes)
+
+    def stats(self):
+        elapsed = time.monotonic() - self.opened_at
+
+        return {
+            "depth": self.depth(),
+            "added": self.state["added"],
+            "consumed": self.state["consumed"],
+            "runs": self.state["runs"],
+            "aborted_runs": self.state["aborted_runs"],
+            "aborted_blocks": self.state["aborted_blocks"],
+            "leaked_bits": self.state["leaked_bits"],
+            "raw_bits": len(self.state["raw_bits"]),
+            "amplified_bits": self.state["amplified_bits"],
+            "secret_bits": self.state["secret_bits"],
+            "unconfirmed_blocks": self.state["unconfirmed_blocks"],
+            "authentication_pads": self.authentication_pads_left(),
+            "fill_rate": self.session_added / self.fill_seconds if self.fill_seconds else 0.0,
+            "consumption_rate": self.session_consumed / elapsed if elapsed else 0.0
+        }
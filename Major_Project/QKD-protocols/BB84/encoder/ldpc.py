@@ -0,0 +1,271 @@
+import time
+import numpy as np
+from math import ceil, log
+from constants import (
+    LDPC_RATES,
+    LDPC_FRAME_LENGTH,
+    LDPC_COLUMN_WEIGHT,
+    LDPC_CODE_SEED,
+    LDPC_MAX_ITERATIONS,
+    LDPC_MIN_SUM_SCALE
+)
+from reconciliation import binary_entropy, cascade
+
+
+# ============================
+# Parity-check matrices
+# ============================
+class ParityCheckMatrix:
+    """
+    Sparse parity-check matrix H of an LDPC code in CSR form: the columns
+    of row i are indices[indptr[i]:indptr[i + 1]]. Every column must hold
+    the same number of ones.
+
+    For decoding, the edges are also laid out in a padded rows x row_width
+    grid, so check and variable updates are reductions over an axis
+    instead of segmented sums. Spare slots point at a dummy column n_columns.
+    """
+
+    def __init__(self, indptr, indices, n_columns):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.n_rows = len(self.indptr) - 1
+        self.n_columns = n_columns
+        self.rate = 1 - self.n_rows / n_columns
+
+        column_weights = np.bincount(self.indices, minlength=n_columns)
+        if column_weights.min() != column_weights.max():
+            raise ValueError("LDPC parity-check matrices must have the same weight in every column")
+        self.column_weight = int(column_weights[0])
+
+        row_weights = np.diff(self.indptr)
+        self.row_width = int(row_weights.max())
+        edge_slots = (
+            np.repeat(np.arange(self.n_rows) * self.row_width - self.indptr[:-1], row_weights)
+            + np.arange(len(self.indices))
+        )
+        self.slot_columns = np.full(self.n_rows * self.row_width, n_columns, dtype=np.int64)
+        self.slot_columns[edge_slots] = self.indices
+        # column_slots[k, j] is the slot of the k-th edge of column j
+        column_order = np.argsort(self.indices, kind="stable")
+        self.column_slots = edge_slots[column_order].reshape(n_columns, self.column_weight).T.copy()
+
+    def gather_slots(self, values, spare_value):
+        """values[:, column] of every slot, spare slots reading spare_value."""
+        spare = np.full((len(values), 1), spare_value, dtype=values.dtype)
+        slots = np.concatenate((values, spare), axis=1)[:, self.slot_columns]
+
+        return slots.reshape(len(values), self.n_rows, self.row_width)
+
+    def syndrome(self, frames):
+        """H @ frame mod 2 for every row of frames (a 2-D 0/1 array)."""
+        return np.add.reduce(self.gather_slots(frames, 0), axis=2, dtype=np.uint8) & 1
+
+    def count_rows_touching(self, n_columns):
+        """Rows with a one in any of the first n_columns columns."""
+        edge_rows = np.repeat(np.arange(self.n_rows), np.diff(self.indptr))
+        return int(np.count_nonzero(np.bincount(edge_rows[self.indices < n_columns], minlength=self.n_rows)))
+
+    def save(self, path):
+        np.savez(path, indptr=self.indptr, indices=self.indices, n_columns=self.n_columns)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["indptr"], data["indices"], int(data["n_columns"]))
+
+
+def make_parity_check_matrix(rate, frame_length=LDPC_FRAME_LENGTH, column_weight=LDPC_COLUMN_WEIGHT, seed=LDPC_CODE_SEED):
+    """
+    Pseudo-random LDPC code: every column has column_weight ones, spread
+    as evenly as possible over the rows. Both sides build the same matrix
+    from the same seed, so only the rate goes over the public channel.
+    """
+    n_rows = ceil((1 - rate) * frame_length)
+    if n_rows < column_weight:
+        raise ValueError(f"A {frame_length} bit frame is too short for an LDPC code of rate {rate}")
+    rng = np.random.default_rng([seed, frame_length, n_rows])
+
+    # deal the column "sockets" out to the rows round-robin
+    columns = rng.permutation(np.repeat(np.arange(frame_length), column_weight))
+    rows = np.arange(len(columns)) % n_rows
+
+    # a column dealt twice to one row would cancel: swap it with a random socket
+    while True:
+        edges = rows * frame_length + columns
+        order = np.argsort(edges, kind="stable")
+        repeated = order[1:][edges[order[1:]] == edges[order[:-1]]]
+        if not len(repeated):
+            break
+
+        partners = rng.integers(0, len(columns), len(repeated))
+        columns[repeated], columns[partners] = columns[partners], columns[repeated]
+
+    rows, columns = np.divmod(edges[order], frame_length)
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=n_rows))))
+
+    return ParityCheckMatrix(indptr, columns, frame_length)
+
+
+LDPC_LIBRARY = {}
+
+
+def get_parity_check_matrix(rate, frame_length=LDPC_FRAME_LENGTH):
+    key = (rate, frame_length)
+    if key not in LDPC_LIBRARY:
+        LDPC_LIBRARY[key] = make_parity_check_matrix(rate, frame_length)
+
+    return LDPC_LIBRARY[key]
+
+
+def select_ldpc_rate(qber, rates=LDPC_RATES):
+    """
+    Highest rate whose measured decoding threshold covers the QBER, e.g.
+    the estimate from calculate_qber. Returns None when none does.
+    """
+    usable = [rate for rate, max_qber in rates.items() if qber <= max_qber]
+
+    return max(usable) if usable else None
+
+
+# ============================
+# Min-sum belief propagation
+# ============================
+def get_channel_llr(bits, qber):
+    """Log-likelihood ratio log(P(0) / P(1)) of every bit Bob holds."""
+    qber = min(max(qber, 1e-6), 0.5 - 1e-6)
+    return (1 - 2 * bits.astype(np.float32)) * np.float32(log((1 - qber) / qber))
+
+
+def decode_min_sum(matrix, syndromes, channel_llr, max_iterations=LDPC_MAX_ITERATIONS, scale=LDPC_MIN_SUM_SCALE):
+    """
+    Scaled min-sum decoding of a batch of frames towards the target
+    syndromes, all frames at once. Frames drop out of the batch as soon as
+    their syndrome matches. Returns (decoded bits, converged, iterations).
+    """
+    n_frames = len(channel_llr)
+    scale = np.float32(scale)
+    decoded = (channel_llr < 0).astype(np.uint8)
+    converged = np.all(matrix.syndrome(decoded) == syndromes, axis=1)
+    iterations = np.zeros(n_frames, dtype=np.int64)
+
+    # spare slots carry an infinite message, which never is the minimum
+    # of a row and never flips its sign
+    active = np.flatnonzero(~converged)
+    v2c = matrix.gather_slots(channel_llr[active], np.inf)
+
+    for iteration in range(1, max_iterations + 1):
+        if not len(active):
+            break
+
+        # check nodes: sign product and the smallest other magnitude
+        magnitudes = np.abs(v2c)
+        min1 = magnitudes.min(axis=2, keepdims=True)
+        is_min = magnitudes == min1
+        min2 = np.where(is_min, np.inf, magnitudes).min(axis=2, keepdims=True)
+        # with two edges at the minimum, the minimum of the others is min1 again
+        tied = np.count_nonzero(is_min, axis=2, keepdims=True) > 1
+        extrinsic = np.where(is_min & ~tied, min2, min1)
+
+        negative = v2c < 0
+        row_signs = np.logical_xor.reduce(negative, axis=2, keepdims=True) ^ syndromes[active, :, None].astype(bool)
+        extrinsic *= scale
+        c2v = np.where(row_signs ^ negative, -extrinsic, extrinsic)
+
+        # variable nodes
+        column_messages = c2v.reshape(len(active), -1)[:, matrix.column_slots]
+        totals = channel_llr[active] + column_messages.sum(axis=1)
+        v2c = matrix.gather_slots(totals, np.inf) - c2v
+
+        decoded[active] = totals < 0
+        iterations[active] = iteration
+        done = np.all(matrix.syndrome(decoded[active]) == syndromes[active], axis=1)
+        converged[active[done]] = True
+
+        active = active[~done]
+        v2c = v2c[~done]
+
+    return decoded, converged, iterations
+
+
+# ============================
+# Syndrome reconciliation
+# ============================
+def split_frames(bits, frame_length):
+    """Cuts a key into frames, padding the last one with zeros."""
+    n_frames = ceil(len(bits) / frame_length)
+    frames = np.zeros(n_frames * frame_length, dtype=np.uint8)
+    frames[:len(bits)] = bits
+
+    return frames.reshape(n_frames, frame_length)
+
+
+def ldpc_reconcile(alice_bits, bob_bits, qber, rate=None, frame_length=LDPC_FRAME_LENGTH):
+    """
+    One-way reconciliation: Alice publishes the syndrome of every frame of
+    her key and Bob decodes his key towards it. The padding of the last
+    frame is known to both sides and decoded as certain. Returns the same
+    fields as cascade, plus the rate and the frames that did not converge.
+    """
+    alice_bits = np.asarray(alice_bits, dtype=np.uint8)
+    bob_bits = np.asarray(bob_bits, dtype=np.uint8)
+    length = len(alice_bits)
+
+    rate = rate or select_ldpc_rate(qber)
+    if rate is None:
+        raise ValueError(f"No LDPC code rate in {list(LDPC_RATES)} corrects a QBER of {qber:.3f}")
+
+    matrix = get_parity_check_matrix(rate, frame_length)
+    syndromes = matrix.syndrome(split_frames(alice_bits, frame_length))
+
+    bob_frames = split_frames(bob_bits, frame_length)
+    channel_llr = get_channel_llr(bob_frames, qber)
+    # padding bits are certain (an infinite LLR would turn into inf - inf)
+    channel_llr.reshape(-1)[length:] = np.float32(1e4)
+
+    decoded, converged, iterations = decode_min_sum(matrix, syndromes, channel_llr)
+    key = decoded.reshape(-1)[:length]
+
+    corrected_errors = int(np.count_nonzero(key != bob_bits))
+    # rows of the last frame that only cover its zero padding have a
+    # syndrome of 0 that Bob knows already, and the frame cannot disclose
+    # more than the key bits it holds
+    full_frames, payload_bits = divmod(length, frame_length)
+    leaked_bits = full_frames * matrix.n_rows
+    if payload_bits:
+        leaked_bits += min(matrix.count_rows_touching(payload_bits), payload_bits)
+    minimum_leak = length * binary_entropy(corrected_errors / length) if length else 0
+
+    return {
+        "key": key,
+        "leaked_bits": leaked_bits,
+        "corrected_errors": corrected_errors,
+        "rate": rate,
+        "failed_frames": int(np.count_nonzero(~converged)),
+        "iterations": int(iterations.max(initial=0)),
+        "efficiency": leaked_bits / minimum_leak if minimum_leak else float("inf")
+    }
+
+
+# ============================
+# Throughput comparison
+# ============================
+def benchmark_reconciliation(length=10**6, qbers=(0.01, 0.02, 0.05)):
+    rng = np.random.default_rng()
+    alice_bits = rng.integers(0, 2, length, dtype=np.uint8)
+
+    for qber in qbers:
+        bob_bits = alice_bits ^ (rng.random(length) < qber).astype(np.uint8)
+
+        for name, reconcile in [("cascade", cascade), ("ldpc", ldpc_reconcile)]:
+            start = time.perf_counter()
+            result = reconcile(alice_bits, bob_bits, qber)
+            elapsed = time.perf_counter() - start
+
+            residual = int(np.count_nonzero(result["key"] != alice_bits))
+            print(f"QBER {qber:.2f} {name:>8}: {length / elapsed / 1e6:7.2f} Mbit/s, "
+                  f"f = {result['efficiency']:.2f}, {residual} residual errors")
+
+
+if __name__ == "__main__":
+    benchmark_reconciliation()
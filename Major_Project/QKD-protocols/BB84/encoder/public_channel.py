@@ -0,0 +1,374 @@
+import json
+import os
+import struct
+import time
+import numpy as np
+from authentication import TAG_RECORD
+from constants import BINARY_CHANNEL, JSON_CHANNEL, LOG_CHANNEL
+from helpers import (
+    mask_to_bases,
+    bases_to_mask,
+    bits_to_array,
+    array_to_bit_string,
+    get_packed_sift_mask
+)
+
+# ============================
+# Binary format
+# ============================
+# header: magic, version, flags, number of rounds, z_bias
+# body:   alice_bases, bob_bases, alice_bits, each bit-packed (1 = X / 1)
+CHANNEL_MAGIC = b"BB84"
+CHANNEL_VERSION = 1
+CHANNEL_HEADER = struct.Struct("<4sHHQd")
+EFFICIENT_FLAG = 1
+PACKED_FIELDS = ["alice_bases", "bob_bases", "alice_bits"]
+
+
+def make_channel(alice_bits, alice_mask, bob_mask, z_bias, efficient):
+    """Public channel contents with the arrays packed eight per byte."""
+    return {
+        "length": len(alice_bits),
+        "z_bias": z_bias,
+        "efficient": efficient,
+        "alice_bases": np.packbits(alice_mask),
+        "bob_bases": np.packbits(bob_mask),
+        "alice_bits": np.packbits(alice_bits)
+    }
+
+
+def unpack_channel(channel):
+    """Returns (alice_bits, alice_bases, bob_bases) as lists, for printing."""
+    length = channel["length"]
+    alice_bits = np.unpackbits(channel["alice_bits"], count=length)
+    alice_bases = np.unpackbits(channel["alice_bases"], count=length).view(bool)
+    bob_bases = np.unpackbits(channel["bob_bases"], count=length).view(bool)
+
+    return list(array_to_bit_string(alice_bits)), mask_to_bases(alice_bases), mask_to_bases(bob_bases)
+
+
+def get_flags(channel):
+    return EFFICIENT_FLAG if channel["efficient"] else 0
+
+
+def get_body_size(length):
+    return len(PACKED_FIELDS) * ((length + 7) // 8)
+
+
+def pack_body(channel):
+    return b"".join(np.ascontiguousarray(channel[field], dtype=np.uint8).tobytes() for field in PACKED_FIELDS)
+
+
+def unpack_body(length, z_bias, flags, body):
+    packed_size = (length + 7) // 8
+    channel = {"length": length, "z_bias": z_bias, "efficient": bool(flags & EFFICIENT_FLAG)}
+
+    for i, field in enumerate(PACKED_FIELDS):
+        channel[field] = body[i * packed_size:(i + 1) * packed_size]
+
+    return channel
+
+
+def write_binary_channel(path, channel):
+    header = CHANNEL_HEADER.pack(CHANNEL_MAGIC, CHANNEL_VERSION, get_flags(channel), channel["length"], channel["z_bias"])
+
+    with open(path, "wb") as f:
+        f.write(header + pack_body(channel))
+
+
+def read_binary_channel(path):
+    with open(path, "rb") as f:
+        magic, version, flags, length, z_bias = CHANNEL_HEADER.unpack(f.read(CHANNEL_HEADER.size))
+
+    if magic != CHANNEL_MAGIC or version != CHANNEL_VERSION:
+        raise ValueError(f"'{path}' is not a version {CHANNEL_VERSION} public channel file")
+
+    # the packed arrays are views into the mapped file, nothing is decoded
+    body_size = get_body_size(length)
+    if body_size:
+        body = np.memmap(path, dtype=np.uint8, mode="r", offset=CHANNEL_HEADER.size, shape=(body_size,))
+    else:
+        body = np.zeros(0, dtype=np.uint8)
+
+    return unpack_body(length, z_bias, flags, body)
+
+
+# ============================
+# Append-only log
+# ============================
+# each frame: magic, version, flags, sequence number, number of rounds,
+# z_bias, then the same packed body as the binary format. A tag frame
+# (TAG_FLAG, no rounds) instead carries the Wegman-Carter tag record of
+# every byte since the previous tag frame. Tag frames carry the sequence
+# number of the next channel frame, so channel frames stay consecutive.
+FRAME_MAGIC = b"BB8F"
+FRAME_HEADER = struct.Struct("<4sHHQQd")
+TAG_FLAG = 2
+
+
+def pack_frame(channel, sequence):
+    header = FRAME_HEADER.pack(FRAME_MAGIC, CHANNEL_VERSION, get_flags(channel), sequence, channel["length"], channel["z_bias"])
+
+    return header + pack_body(channel)
+
+
+def pack_tag_frame(record, sequence):
+    return FRAME_HEADER.pack(FRAME_MAGIC, CHANNEL_VERSION, TAG_FLAG, sequence, 0, 0.0) + record
+
+
+def get_frame_body_size(flags, length):
+    return TAG_RECORD.size if flags & TAG_FLAG else get_body_size(length)
+
+
+def read_frame_header(f, offset):
+    header = f.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+
+    magic, version, flags, sequence, length, z_bias = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC or version != CHANNEL_VERSION:
+        raise ValueError(f"Corrupt public channel frame at offset {offset}")
+
+    return flags, sequence, length, z_bias
+
+
+def read_channel_frames(path, offset=0, verifier=None):
+    """
+    Yields (sequence, channel, end_offset) for every complete frame after
+    offset. A frame still being appended is left for the next call.
+
+    With a verifier (an Authenticator), frames are only yielded once a tag
+    frame has authenticated them, and a wrong tag raises ValueError. The
+    end_offset of the last frame before a tag points past the tag frame.
+    """
+    pending = []
+    segment_start = offset
+
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            header = read_frame_header(f, offset)
+            if header is None:
+                return
+
+            flags, sequence, length, z_bias = header
+            body_size = get_frame_body_size(flags, length)
+            body = f.read(body_size)
+            if len(body) < body_size:
+                return
+
+            frame_start = offset
+            offset += FRAME_HEADER.size + body_size
+
+            if not flags & TAG_FLAG:
+                frame = (sequence, unpack_body(length, z_bias, flags, np.frombuffer(body, dtype=np.uint8)), offset)
+                if verifier is None:
+                    yield frame
+                else:
+                    pending.append(frame)
+                continue
+
+            if verifier is None:
+                continue
+
+            with open(path, "rb") as segment_file:
+                segment_file.seek(segment_start)
+                segment = segment_file.read(frame_start - segment_start)
+
+            if not verifier.verify(segment, body):
+                raise ValueError(f"Public channel frames before offset {frame_start} failed authentication.")
+
+            for i, (frame_sequence, channel, frame_end) in enumerate(pending):
+                yield frame_sequence, channel, offset if i == len(pending) - 1 else frame_end
+
+            pending = []
+            segment_start = offset
+
+
+def scan_channel_log(path):
+    """
+    Returns (end of the last complete frame, next sequence number, end of
+    the last tag frame), reading headers only.
+    """
+    end_offset, next_sequence, tagged_offset = 0, 0, 0
+    file_size = os.path.getsize(path)
+
+    with open(path, "rb") as f:
+        while True:
+            header = read_frame_header(f, end_offset)
+            if header is None:
+                break
+
+            flags, sequence, length, _ = header
+            frame_end = end_offset + FRAME_HEADER.size + get_frame_body_size(flags, length)
+            if frame_end > file_size:
+                break
+
+            f.seek(frame_end)
+            end_offset = frame_end
+            if flags & TAG_FLAG:
+                tagged_offset = frame_end
+            else:
+                next_sequence = sequence + 1
+
+    return end_offset, next_sequence, tagged_offset
+
+
+class ChannelLogWriter:
+    """
+    Appends channel frames to a log file, continuing its sequence numbers.
+    With an authenticator, append_tag signs everything written since the
+    last tag frame.
+    """
+
+    def __init__(self, path, authenticator=None):
+        self.path = path
+        self.authenticator = authenticator
+        self.end_offset, self.next_sequence, self.tagged_offset = 0, 0, 0
+
+        if os.path.exists(path):
+            self.end_offset, self.next_sequence, self.tagged_offset = scan_channel_log(path)
+            # drop a frame left half-written by an interrupted sender
+            if os.path.getsize(path) > self.end_offset:
+                os.truncate(path, self.end_offset)
+
+    def write_frame(self, frame):
+        with open(self.path, "ab") as f:
+            f.write(frame)
+
+        self.end_offset += len(frame)
+
+    def append(self, channel):
+        self.write_frame(pack_frame(channel, self.next_sequence))
+        self.next_sequence += 1
+
+    def append_tag(self):
+        if self.authenticator is None or self.end_offset == self.tagged_offset:
+            return
+
+        with open(self.path, "rb") as f:
+            f.seek(self.tagged_offset)
+            segment = f.read(self.end_offset - self.tagged_offset)
+
+        self.write_frame(pack_tag_frame(self.authenticator.sign(segment), self.next_sequence))
+        self.tagged_offset = self.end_offset
+
+
+def is_channel_log(path):
+    with open(path, "rb") as f:
+        return f.read(len(FRAME_MAGIC)) == FRAME_MAGIC
+
+
+def load_channel_offset(offset_file):
+    """Returns (offset, next sequence number) stored by the last tail, or the start of the log."""
+    if not os.path.exists(offset_file):
+        return 0, 0
+
+    with open(offset_file, "r") as f:
+        data = json.load(f)
+
+    return data["offset"], data["next_sequence"]
+
+
+def save_channel_offset(offset_file, offset, next_sequence):
+    # written to a temporary file first, so a crash never leaves half an offset
+    temporary_file = offset_file + ".tmp"
+    with open(temporary_file, "w") as f:
+        json.dump({"offset": offset, "next_sequence": next_sequence}, f)
+
+    os.replace(temporary_file, offset_file)
+
+
+# ============================
+# JSON format (debugging)
+# ============================
+def write_json_channel(path, channel):
+    alice_bits, alice_bases, bob_bases = unpack_channel(channel)
+    public_data = {
+        "alice_bases": alice_bases,
+        "bob_bases": bob_bases,
+        "simulated_alice_bits": alice_bits,
+        "z_bias": channel["z_bias"],
+        "efficient": channel["efficient"]
+    }
+
+    with open(path, "w") as f:
+        json.dump(public_data, f, indent=4)
+
+
+def read_json_channel(path):
+    with open(path, "r") as f:
+        public_data = json.load(f)
+
+    # channels written before efficient mode existed are plain BB84
+    return make_channel(
+        bits_to_array(public_data["simulated_alice_bits"]),
+        bases_to_mask(public_data["alice_bases"]),
+        bases_to_mask(public_data["bob_bases"]),
+        public_data.get("z_bias", 0.5),
+        public_data.get("efficient", False)
+    )
+
+
+# ============================
+# Any format
+# ============================
+def write_public_channel(path, channel, channel_format=BINARY_CHANNEL):
+    if channel_format == JSON_CHANNEL:
+        write_json_channel(path, channel)
+    elif channel_format == BINARY_CHANNEL:
+        write_binary_channel(path, channel)
+    elif channel_format == LOG_CHANNEL:
+        ChannelLogWriter(path).append(channel)
+    else:
+        raise ValueError(f"Unknown public channel format: {channel_format}")
+
+
+def read_public_channel(path):
+    """Reads a JSON or binary channel, telling them apart by the magic bytes."""
+    with open(path, "rb") as f:
+        magic = f.read(len(CHANNEL_MAGIC))
+
+    if magic == CHANNEL_MAGIC:
+        return read_binary_channel(path)
+    return read_json_channel(path)
+
+
+def sift_public_channel(channel):
+    """Sifted key straight from the packed arrays."""
+    sift_mask = get_packed_sift_mask(
+        channel["alice_bases"],
+        channel["bob_bases"],
+        channel["length"],
+        channel["z_bias"],
+        channel["efficient"]
+    )
+    alice_bits = np.unpackbits(channel["alice_bits"], count=channel["length"])
+
+    return array_to_bit_string(alice_bits[sift_mask])
+
+
+# ============================
+# Size and parse-time comparison
+# ============================
+def benchmark_public_channel(rounds=10**6, directory="."):
+    rng = np.random.default_rng()
+    alice_bits = rng.integers(0, 2, rounds, dtype=np.uint8)
+    alice_mask, bob_mask = rng.random((2, rounds)) >= 0.5
+    channel = make_channel(alice_bits, alice_mask, bob_mask, 0.5, False)
+
+    for channel_format in [JSON_CHANNEL, BINARY_CHANNEL]:
+        path = os.path.join(directory, f"benchmark_channel.{channel_format}")
+        write_public_channel(path, channel, channel_format)
+
+        start = time.perf_counter()
+        sifted_key = sift_public_channel(read_public_channel(path))
+        elapsed = time.perf_counter() - start
+
+        print(f"{channel_format:>6}: {os.path.getsize(path):>12,} bytes, "
+              f"read + sift {elapsed * 1000:9.1f} ms, {len(sifted_key)} sifted bits")
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    benchmark_public_channel()
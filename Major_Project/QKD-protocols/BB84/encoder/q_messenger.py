@@ -1,11 +1,23 @@
 import os
+import secrets
 import bb84_engine
-from constants import QBER_THRESHOLD
-from helpers import text_to_binary, binary_to_text, xor_encrypt_decrypt
-
-PUBLIC_CHANNEL_FILE = "public_channel.json"
-MESSAGE_FILE = "encrypted_message.txt"
-FINAL_KEY_FILE = "final_key.txt"
+from authentication import Authenticator
+from constants import KEY_POOL_MAX_RUNS, AUTH_SLICE_SIZE
+from helpers import (
+    iter_text_chunks,
+    get_utf8_length,
+    decode_text_chunks,
+    encrypt_chunks_to_file,
+    get_ciphertext_info,
+    iter_decrypted_chunks
+)
+from key_pool import KeyPool
+
+PUBLIC_CHANNEL_FILE = "public_channel.log"
+CHANNEL_OFFSET_FILE = "public_channel.offset"
+MESSAGE_FILE = "encrypted_message.bin"
+KEY_POOL_FILE = "key_pool.bin"
+PRESHARED_KEY_FILE = "preshared.key"
 
 
 # ===================== MENU =====================
@@ -15,56 +27,70 @@ def display_menu():
     print("=" * 40)
     print("1. Send a secure message (Alice)")
     print("2. Receive a secure message (Bob)")
-    print("3. Exit")
+    print("3. Key pool status")
+    print("4. Exit")
     print("-" * 40)
 
 
-# ===================== SENDER (ALICE) =====================
-def sender_workflow():
-    print("\n--- SENDER (ALICE) ---")
+# ===================== KEY POOL =====================
+def get_preshared_key():
+    # stands in for the secret Alice and Bob agree on before their first
+    # session; it authenticates the public channel until QKD key takes over
+    if not os.path.exists(PRESHARED_KEY_FILE):
+        with open(PRESHARED_KEY_FILE, "wb") as f:
+            f.write(secrets.token_bytes(AUTH_SLICE_SIZE))
 
-    message = input("Enter message to encrypt: ")
+    with open(PRESHARED_KEY_FILE, "rb") as f:
+        return f.read()
 
-    print("\n[1] Running BB84 protocol (Alice)...")
-    alice_sifted_key = bb84_engine.generate_key_for_sender(PUBLIC_CHANNEL_FILE)
+def print_pool_stats(key_pool):
+    stats = key_pool.stats()
 
-    if not alice_sifted_key:
-        print("❌ Key generation failed.")
-        return
+    print(f"✔ Key pool: {stats['depth']} bytes left, {stats['consumed']} of {stats['added']} bytes used")
+    print(f"✔ BB84 runs: {stats['runs']} ({stats['aborted_runs']} aborted on QBER), "
+          f"{stats['leaked_bits']} bits leaked in reconciliation")
+    print(f"✔ Blocks: {stats['aborted_blocks']} aborted on their final QBER test")
+    print(f"✔ Privacy amplification: {stats['amplified_bits']} reconciled bits -> {stats['secret_bits']} secret bits, "
+          f"{stats['raw_bits']} bits waiting for the next block, "
+          f"{stats['unconfirmed_blocks']} blocks failed key confirmation")
+    print(f"✔ Authentication: {stats['authentication_pads']} tag pads left in the reserved slice")
+    print(f"✔ Fill rate: {stats['fill_rate']:.1f} B/s, consumption rate: {stats['consumption_rate']:.1f} B/s")
 
-    print(f"✔ Alice sifted key length: {len(alice_sifted_key)} bits")
 
-    # 🔐 Privacy amplification (simulation)
-    qber, final_key = bb84_engine.calculate_qber(
-        alice_sifted_key,
-        alice_sifted_key
-    )
+def pool_status_workflow():
+    print("\n--- KEY POOL ---")
+    print_pool_stats(KeyPool(KEY_POOL_FILE))
+
 
-    print(f"✔ QBER: {qber * 100:.2f}%")
+# ===================== SENDER (ALICE) =====================
+def sender_workflow():
+    print("\n--- SENDER (ALICE) ---")
 
-    if qber > QBER_THRESHOLD:
-        print("❌ QBER too high. Abort.")
+    message = input("Enter message to encrypt: ")
+    message_length = get_utf8_length(message)
+
+    # 🔐 the pool runs BB84 until it holds a one-time pad for the whole message
+    print(f"\n[1] Filling key pool with {message_length} bytes (Alice)...")
+    key_pool = KeyPool(
+        KEY_POOL_FILE,
+        public_channel_file=PUBLIC_CHANNEL_FILE,
+        max_runs=KEY_POOL_MAX_RUNS,
+        preshared_key=get_preshared_key()
+    )
+
+    try:
+        key_offset, key_bytes = key_pool.take(message_length)
+    except RuntimeError as error:
+        # the pool says why: runs aborted on QBER, or no authenticated key
+        # left for the next authentication slice
+        print(f"❌ {error} Abort.")
         return
 
+    print_pool_stats(key_pool)
     print("✅ Secure key established.")
 
-    # Save final key so Bob uses THE SAME ONE
-    with open(FINAL_KEY_FILE, "w") as f:
-        f.write(final_key)
-
     # ===================== ENCRYPT =====================
-    binary_message = text_to_binary(message)
-
-    usable_length = min(len(binary_message), len(final_key))
-    usable_length = (usable_length // 8) * 8  # 🔑 byte alignment
-
-    binary_message = binary_message[:usable_length]
-    encryption_key = final_key[:usable_length]
-
-    encrypted_binary = xor_encrypt_decrypt(binary_message, encryption_key)
-
-    with open(MESSAGE_FILE, "w") as f:
-        f.write(encrypted_binary)
+    encrypt_chunks_to_file(iter_text_chunks(message), MESSAGE_FILE, key_bytes, key_offset)
 
     print("✔ Message encrypted and sent securely.")
     print("✔ Ask Bob to run option 2.\n")
@@ -78,39 +104,37 @@ def receiver_workflow():
         print("❌ Public channel file not found.")
         return
 
-    if not os.path.exists(FINAL_KEY_FILE):
-        print("❌ Final key not found. Ask Alice to send message first.")
+    if not os.path.exists(MESSAGE_FILE):
+        print("❌ Encrypted message not found. Ask Alice to send message first.")
         return
 
     print("\n[1] Replicating sifted key (Bob)...")
-    bob_sifted_key = bb84_engine.replicate_key_for_receiver(PUBLIC_CHANNEL_FILE)
-
-    if not bob_sifted_key:
-        print("❌ Key replication failed.")
+    key_pool = KeyPool(KEY_POOL_FILE)
+
+    # only the rounds published since Bob's last visit are sifted, and
+    # only once Alice's Wegman-Carter tag over them checks out
+    try:
+        bob_sifted_key = bb84_engine.replicate_key_for_receiver(
+            PUBLIC_CHANNEL_FILE,
+            offset_file=CHANNEL_OFFSET_FILE,
+            verifier=Authenticator(key_pool)
+        )
+    except ValueError as error:
+        print(f"❌ {error} Public channel tampered with. Abort.")
         return
 
-    print(f"✔ Bob sifted key length: {len(bob_sifted_key)} bits")
+    print(f"✔ Bob sifted {len(bob_sifted_key)} new authenticated bits")
 
-    # Bob loads SAME final key (no regeneration!)
-    with open(FINAL_KEY_FILE, "r") as f:
-        final_key = f.read()
+    # Bob reads the SAME pad range Alice used (no regeneration!)
+    message_length, key_offset = get_ciphertext_info(MESSAGE_FILE)
+    key_bytes = key_pool.read(key_offset, message_length)
 
-    print(f"✔ Final secure key length: {len(final_key)} bits")
+    print(f"✔ Pad: {message_length} bytes at key pool offset {key_offset}")
 
     # ===================== DECRYPT =====================
     print("\n[2] Decrypting message...")
 
-    with open(MESSAGE_FILE, "r") as f:
-        encrypted_binary = f.read()
-
-    usable_length = min(len(encrypted_binary), len(final_key))
-    usable_length = (usable_length // 8) * 8
-
-    encrypted_binary = encrypted_binary[:usable_length]
-    decryption_key = final_key[:usable_length]
-
-    decrypted_binary = xor_encrypt_decrypt(encrypted_binary, decryption_key)
-    decrypted_message = binary_to_text(decrypted_binary)
+    decrypted_message = decode_text_chunks(iter_decrypted_chunks(MESSAGE_FILE, key_bytes))
 
     print("\n✅ SUCCESS: Message decrypted!")
     print(f"Decoded Message: {decrypted_message}")
@@ -120,13 +144,15 @@ def receiver_workflow():
 def main():
     while True:
         display_menu()
-        choice = input("Enter your choice (1-3): ")
+        choice = input("Enter your choice (1-4): ")
 
         if choice == '1':
             sender_workflow()
         elif choice == '2':
             receiver_workflow()
         elif choice == '3':
+            pool_status_workflow()
+        elif choice == '4':
             print("Exiting...")
             break
         else:
@@ -0,0 +1,174 @@
+import numpy as np
+from math import ceil, log2
+from constants import CASCADE_PASSES, CASCADE_MIN_BLOCK_SIZE
+
+
+# ============================
+# QBER test sample
+# ============================
+def reveal_test_sample(alice_bits, bob_bits, test_fraction, rng=None):
+    """
+    Compares a random test_fraction of the two keys in public. Returns the
+    errors in the sample, its size and both keys without the revealed bits.
+    """
+    assert len(alice_bits) == len(bob_bits)
+
+    rng = rng or np.random.default_rng()
+    key_len = len(alice_bits)
+    test_size = max(1, int(key_len * test_fraction))
+
+    test_indices = rng.choice(key_len, test_size, replace=False)
+    errors = int(np.count_nonzero(alice_bits[test_indices] != bob_bits[test_indices]))
+
+    keep_mask = np.ones(key_len, dtype=bool)
+    keep_mask[test_indices] = False
+
+    return {
+        "errors": errors,
+        "test_size": test_size,
+        "alice_bits": alice_bits[keep_mask],
+        "bob_bits": bob_bits[keep_mask]
+    }
+
+
+# ============================
+# Cascade
+# ============================
+def binary_entropy(p):
+    if p <= 0 or p >= 1:
+        return 0.0
+    return -p * log2(p) - (1 - p) * log2(1 - p)
+
+
+def get_cascade_block_sizes(qber, length, passes=CASCADE_PASSES):
+    # k1 = 0.73 / QBER puts about 0.73 errors in a first-pass block,
+    # and every later pass doubles the block size
+    first_block_size = ceil(0.73 / qber) if qber > 0 else length
+    first_block_size = max(CASCADE_MIN_BLOCK_SIZE, min(first_block_size, length))
+
+    return [min(first_block_size << i, length) for i in range(passes)]
+
+
+def get_prefix_parities(bits):
+    """prefix[i] is the parity of bits[:i], so parity(bits[a:b]) = prefix[a] ^ prefix[b]."""
+    prefix = np.zeros(len(bits) + 1, dtype=np.uint8)
+    np.bitwise_xor.accumulate(bits, out=prefix[1:])
+    return prefix
+
+
+class CascadePass:
+    """One shuffle of the key cut into blocks of block_size bits."""
+
+    def __init__(self, alice_bits, bob_bits, block_size, permutation):
+        self.length = len(alice_bits)
+        self.block_size = block_size
+        self.permutation = permutation
+        # block of every original position, to find the blocks a correction touches
+        self.block_of = np.empty(self.length, dtype=np.int64)
+        self.block_of[permutation] = np.arange(self.length) // block_size
+
+        self.block_starts = np.arange(0, self.length, block_size)
+        self.block_ends = np.minimum(self.block_starts + block_size, self.length)
+        self.alice_prefix = get_prefix_parities(alice_bits[permutation])
+
+        bob_prefix = get_prefix_parities(bob_bits[permutation])
+        self.odd_blocks = self.get_parity_differences(bob_prefix, self.block_starts, self.block_ends)
+
+    def get_parity_differences(self, bob_prefix, starts, ends):
+        alice_parities = self.alice_prefix[starts] ^ self.alice_prefix[ends]
+        bob_parities = bob_prefix[starts] ^ bob_prefix[ends]
+        return alice_parities != bob_parities
+
+    def find_errors(self, bob_bits):
+        """
+        Binary search in every odd block at once. Returns the original
+        positions of one error per odd block and the number of parities
+        Alice disclosed.
+        """
+        blocks = np.flatnonzero(self.odd_blocks)
+        bob_prefix = get_prefix_parities(bob_bits[self.permutation])
+        starts = self.block_starts[blocks]
+        ends = self.block_ends[blocks]
+        leaked_bits = 0
+
+        while True:
+            searching = ends - starts > 1
+            if not searching.any():
+                break
+
+            middles = (starts + ends) // 2
+            # the error is in the left half if the left halves' parities differ
+            left_odd = self.get_parity_differences(bob_prefix, starts, middles)
+            leaked_bits += int(np.count_nonzero(searching))
+
+            ends = np.where(searching & left_odd, middles, ends)
+            starts = np.where(searching & ~left_odd, middles, starts)
+
+        return self.permutation[starts], leaked_bits
+
+    def flip(self, positions):
+        # a corrected bit changes the parity of its block in this pass
+        np.logical_xor.at(self.odd_blocks, self.block_of[positions], True)
+
+
+def cascade(alice_bits, bob_bits, qber, passes=CASCADE_PASSES, seed=None):
+    """
+    Cascade reconciliation of Bob's key against Alice's, both 0/1 uint8
+    arrays. The shuffles come from seed, which both sides share over the
+    public channel. Returns Bob's corrected key and the leak accounting.
+    """
+    alice_bits = np.asarray(alice_bits, dtype=np.uint8)
+    bob_bits = np.array(bob_bits, dtype=np.uint8)
+    length = len(alice_bits)
+    rng = np.random.default_rng(seed)
+
+    cascade_passes = []
+    leaked_bits = 0
+    corrected_errors = 0
+
+    for pass_index, block_size in enumerate(get_cascade_block_sizes(qber, length, passes) if length else []):
+        permutation = np.arange(length) if pass_index == 0 else rng.permutation(length)
+        cascade_pass = CascadePass(alice_bits, bob_bits, block_size, permutation)
+        cascade_passes.append(cascade_pass)
+        leaked_bits += len(cascade_pass.block_starts)
+
+        # a correction makes blocks of earlier passes odd again, which is
+        # the cascade: keep searching until every block of every pass is even
+        while True:
+            odd_passes = [p for p in cascade_passes if p.odd_blocks.any()]
+            if not odd_passes:
+                break
+
+            for odd_pass in odd_passes:
+                if not odd_pass.odd_blocks.any():
+                    continue
+
+                positions, search_leak = odd_pass.find_errors(bob_bits)
+                leaked_bits += search_leak
+                corrected_errors += len(positions)
+                bob_bits[positions] ^= 1
+
+                for p in cascade_passes:
+                    p.flip(positions)
+
+    error_rate = corrected_errors / length if length else 0.0
+    minimum_leak = length * binary_entropy(error_rate)
+
+    return {
+        "key": bob_bits,
+        "leaked_bits": leaked_bits,
+        "corrected_errors": corrected_errors,
+        "passes": len(cascade_passes),
+        # leak relative to the Shannon limit n * h(QBER); 1.0 would be perfect
+        "efficiency": leaked_bits / minimum_leak if minimum_leak else float("inf")
+    }
+
+
+def reconcile_packed_keys(alice_packed, bob_packed, length, qber, passes=CASCADE_PASSES, seed=None):
+    """Cascade on keys packed eight bits per byte; the corrected key is returned packed too."""
+    alice_bits = np.unpackbits(alice_packed, count=length)
+    bob_bits = np.unpackbits(bob_packed, count=length)
+
+    result = cascade(alice_bits, bob_bits, qber, passes, seed)
+    result["key"] = np.packbits(result["key"])
+    return result
@@ -2,52 +2,75 @@ from helpers import *
 from qiskit import IBMQ
 
 
-def bb84():
-    use_simulator = input("Run using simulator?(y/n): ").lower()
-    shots = 1
-    backend = QasmSimulator()
-    accuracy = 100
+def bb84(engine=QISKIT_ENGINE, single_job=True, entropy_source=ENTROPY_SOURCE):
+    if engine == NUMPY_ENGINE:
+        size = int(input("Enter desired length of bits: "))
+        print("\n")
 
-    size = int(input("Enter desired length of bits (max:29): "))
-    alice_bits = get_random_sequence_of_bits(size)
-    alice_bases = get_random_sequence_of_bases(size)
-    bob_bases = get_random_sequence_of_bases(size)
-    eve_bases = get_random_sequence_of_bases(size)
+        run = simulate_bb84_numpy(size, np.random.default_rng())
+        alice_bits = array_to_bits(run["alice_bits"])
+        alice_bases = array_to_bases(run["alice_bases"])
+        alice_states = array_to_states(run["alice_states"])
+        eve_bases = array_to_bases(run["eve_bases"])
+        eve_measurements = array_to_bits(run["eve_measurements"])
+        bob_bases = array_to_bases(run["bob_bases"])
+        bob_measurements = array_to_bits(run["bob_measurements"])
+    else:
+        use_simulator = input("Run using simulator?(y/n): ").lower()
+        shots = 1
+        backend = QasmSimulator()
+        accuracy = 100
 
-    if use_simulator == "n":
-        print("Loading IBM account")
-        my_provider = IBMQ.load_account()
-        backend = my_provider.get_backend('ibmq_manila')
-        shots = int(input("Enter desired number of shots: "))
-        accuracy = int(input("Enter desired accuracy: "))
+        size = int(input("Enter desired length of bits: "))
+        set_entropy_source(entropy_source)
+        alice_bits = get_random_sequence_of_bits(size)
+        alice_bases = get_random_sequence_of_bases(size)
+        bob_bases = get_random_sequence_of_bases(size)
+        eve_bases = get_random_sequence_of_bases(size)
 
-    print("\n")
+        if use_simulator == "n":
+            print("Loading IBM account")
+            my_provider = IBMQ.load_account()
+            backend = my_provider.get_backend('ibmq_manila')
+            shots = int(input("Enter desired number of shots: "))
+            accuracy = int(input("Enter desired accuracy: "))
 
-    alice_states = get_states(alice_bits, alice_bases)
-    size = len(alice_bits)
-    circuit = QuantumCircuit(size, size)
-    initialize_circuit_with_zeros(circuit)
+        print("\n")
 
-    insert_states_in_circuit(circuit, alice_states)
+        alice_states = get_states(alice_bits, alice_bases)
+        size = len(alice_bits)
+        circuits = get_block_circuits(size, registers=2 if single_job else 1)
 
-    # Eve makes measurements
-    insert_measurements_according_to_base(eve_bases, circuit)
-    circuit.barrier()
-    eve_measurements = get_measurements_result(backend, circuit, shots, accuracy, size)
-    eve_states_for_bob = get_states(eve_measurements, eve_bases)
-    reset_circuit(circuit, size)
-    insert_states_in_circuit(circuit, eve_states_for_bob)
+        insert_states_in_blocks(circuits, alice_states)
 
-    insert_measurements_according_to_base(bob_bases, circuit)
-    bob_measurements = get_measurements_result(backend, circuit, shots, accuracy, size)
+        if single_job:
+            # Eve measures and resends, then Bob measures, in the same shots
+            insert_intercept_resend_in_blocks(eve_bases, bob_bases, circuits)
+            eve_measurements, bob_measurements = get_intercept_measurements_result(backend, circuits, shots, accuracy)
+        else:
+            # Eve makes measurements
+            insert_measurements_in_blocks(eve_bases, circuits)
+            for circuit in circuits:
+                circuit.barrier()
+            eve_measurements = get_blocks_measurements_result(backend, circuits, shots, accuracy)
+            eve_states_for_bob = get_states(eve_measurements, eve_bases)
+            reset_blocks(circuits)
+            insert_states_in_blocks(circuits, eve_states_for_bob)
 
-    same_bases_positions = get_same_bases_positions(alice_bases, bob_bases)
+            insert_measurements_in_blocks(bob_bases, circuits)
+            bob_measurements = get_blocks_measurements_result(backend, circuits, shots, accuracy)
+        save_circuit_image(circuits[0], "bb84_circuit_with_eve")
 
-    alice_sifted_key = discard_different_positions(alice_bits, same_bases_positions)
-    bob_sifted_key = discard_different_positions(bob_measurements, same_bases_positions)
-    eve_sifted_key = discard_different_positions(eve_measurements, same_bases_positions)
+    alice_key = PackedKey.from_bits(alice_bits, alice_bases)
+    bob_key = PackedKey.from_bits(bob_measurements, bob_bases)
+    eve_key = PackedKey.from_bits(eve_measurements, eve_bases)
+    same_bases = alice_key.same_bases(bob_key)
+    same_bases_positions = np.flatnonzero(same_bases).tolist()
+
+    alice_sifted_key = alice_key.select(same_bases)
+    bob_sifted_key = bob_key.select(same_bases)
+    eve_sifted_key = eve_key.select(same_bases)
 
-    save_circuit_image(circuit, "bb84_circuit_with_eve")
     print("\nBB84 protocol with intervention\n")
     print(f"Alice bits:       {alice_bits}")
     print(f"Alice bases:      {alice_bases}")
@@ -57,13 +80,13 @@ def bb84():
     print(f"Bob bases:        {bob_bases}")
     print(f"Bob measurements: {bob_measurements}\n")
     print(f"Same bases positions: {same_bases_positions}\n")
-    print(f"Alice sifted key: {alice_sifted_key}")
-    print(f"Eve sifted key:   {eve_sifted_key}")
-    print(f"Bob sifted key:   {bob_sifted_key}\n")
+    print(f"Alice sifted key: {alice_sifted_key.to_bits()}")
+    print(f"Eve sifted key:   {eve_sifted_key.to_bits()}")
+    print(f"Bob sifted key:   {bob_sifted_key.to_bits()}\n")
 
     privacy_amplification = input("Perform privacy amplification?(y/n): ").lower()
     if privacy_amplification == "y":
-        perform_privacy_amplification(alice_sifted_key, bob_sifted_key)
+        alice_sifted_key, bob_sifted_key = perform_privacy_amplification(alice_sifted_key, bob_sifted_key)
 
     encrypt = input("Encrypt message?(y/n): ").lower()
     if encrypt == "y":
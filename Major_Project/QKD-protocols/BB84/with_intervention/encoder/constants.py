@@ -6,3 +6,7 @@ STATE_0 = "|0>"
 STATE_1 = "|1>"
 STATE_PLUS = "|+>"
 STATE_MINUS = "|->"
+QBER_TEST_FRACTION = 0.2   # share of the sifted key revealed to estimate the QBER
+# read by the main encoder's reconciliation module, which the messenger imports
+CASCADE_PASSES = 4
+CASCADE_MIN_BLOCK_SIZE = 4
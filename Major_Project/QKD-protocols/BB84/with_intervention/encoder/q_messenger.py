@@ -1,6 +1,14 @@
 import os
+import sys
+import numpy as np
 import bb84_engine
 from helpers import text_to_binary, binary_to_text, xor_encrypt_decrypt, colors
+from constants import QBER_TEST_FRACTION
+
+# Cascade and the QBER test sample come from the main encoder; its folder
+# goes last on the path so this folder's helpers and constants still win
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "encoder"))
+from reconciliation import cascade, reveal_test_sample
 
 PUBLIC_CHANNEL_FILE = "public_channel.json"
 MESSAGE_FILE = "encrypted_message.txt"
@@ -45,7 +53,16 @@ def sender_workflow(with_eve=False):
         if alice_sifted_key != bob_sifted_key:
             print(f"\n{colors.RED}!! SECURITY ALERT !!{colors.ENDC}")
             print("Alice's and Bob's keys DO NOT MATCH. An eavesdropper was detected!")
-            print("Protocol would be aborted in a real-world scenario.")
+            print("Protocol aborted: no message is sent.")
+
+            # the old ciphertext does not belong to the bases just published
+            if os.path.exists(MESSAGE_FILE):
+                os.remove(MESSAGE_FILE)
+
+            choice = input("\nReconcile the keys anyway to see what Cascade discloses? (y/N): ")
+            if choice.strip().lower() == 'y':
+                reconciliation_demo(message, alice_sifted_key, bob_sifted_key)
+            return
         else:
             print(f"\n{colors.GREEN}Keys match. Eve was not detected (by luck).{colors.ENDC}")
 
@@ -62,6 +79,41 @@ def sender_workflow(with_eve=False):
     print(f"\nThe receiver can now run option 3 to decode.")
 
 
+def reconciliation_demo(message, alice_sifted_key, bob_sifted_key):
+    """
+    Shows what reconciliation would make of the keys Eve disturbed. Bob's
+    reconciled key stays in this process: the message is encrypted with
+    Alice's key and decrypted with Bob's right here, and nothing is sent.
+    """
+    print("\nDEMO: Estimating the QBER and reconciling Bob's key with Cascade...")
+    alice_bits = (np.array(list(alice_sifted_key)) == "1").astype(np.uint8)
+    bob_bits = (np.array(list(bob_sifted_key)) == "1").astype(np.uint8)
+
+    sample = reveal_test_sample(alice_bits, bob_bits, QBER_TEST_FRACTION)
+    if not sample["alice_bits"].size:
+        print(f"{colors.RED}The QBER test used up the whole key, nothing is left to reconcile.{colors.ENDC}")
+        return
+
+    qber = sample["errors"] / sample["test_size"]
+    result = cascade(sample["alice_bits"], sample["bob_bits"], qber)
+    alice_key = "".join(map(str, sample["alice_bits"]))
+    bob_key = "".join(map(str, result["key"]))
+
+    print(f"  - Estimated QBER: {qber * 100:.1f}%, {result['corrected_errors']} errors corrected in {result['passes']} passes")
+    print(f"  - Parity bits disclosed: {result['leaked_bits']}")
+    print(f"  - Alice's Key after the test ({len(alice_key)} bits): {alice_key}")
+    print(f"  - Bob's Reconciled Key       ({len(bob_key)} bits): {bob_key}")
+
+    if bob_key != alice_key:
+        print(f"{colors.RED}Errors remain: some blocks held an even number of them.{colors.ENDC}")
+    if result["leaked_bits"] >= len(bob_key):
+        print(f"{colors.RED}Cascade disclosed as many bits as the key holds, so none of it is secret.{colors.ENDC}")
+
+    encrypted_binary = xor_encrypt_decrypt(text_to_binary(message), alice_key)
+    decrypted_message = binary_to_text(xor_encrypt_decrypt(encrypted_binary, bob_key))
+    print(f"  - Encrypted with Alice's key, decrypted with Bob's: {colors.YELLOW}{decrypted_message}{colors.ENDC}")
+
+
 def receiver_workflow():
     """Handles the process of decoding a received message."""
     print("\n--- RECEIVER (BOB) ---")
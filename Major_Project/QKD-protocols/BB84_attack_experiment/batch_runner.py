@@ -0,0 +1,119 @@
+from multiprocessing import Pool
+from bb84 import run_bb84, run_bb84_batch, get_output_name
+from helpers import save_circuit_image, set_entropy_source, seed_entropy_pool, seed_simulator_jobs
+from constants import ENTROPY_SOURCE, CIRCUIT_ENTROPY, QRNG_ENTROPY, CSPRNG_ENTROPY
+from results_store import ResultsWriter
+import argparse
+import numpy as np
+import os
+import random
+
+# workers are replaced after this many runs so their memory stays bounded
+RUNS_PER_WORKER = 25
+
+
+def seed_run(seed_sequence, reproducible):
+    # every run gets its own stream, so forked workers never repeat draws
+    np_seed, python_seed = seed_sequence.generate_state(2)
+    np.random.seed(np_seed)
+    random.seed(int(python_seed))
+
+    # with --seed the bits, bases and Aer's sampling come from the run's stream
+    # too; without it the chosen entropy source stays in charge
+    if reproducible:
+        entropy_seed, simulator_seed = seed_sequence.spawn(2)
+        seed_entropy_pool(entropy_seed)
+        seed_simulator_jobs(simulator_seed)
+
+
+def run_seeded_bb84(task):
+    run_id, seed_sequence, reproducible, simulator, accuracy, size, spy = task
+    seed_run(seed_sequence, reproducible)
+
+    keys, circuit = run_bb84(simulator, accuracy, size, spy)
+
+    # only the first run sends its circuit back for the image
+    return run_id, keys, circuit if run_id == 0 else None
+
+
+def run_tasks(tasks, workers, simulator):
+    if not simulator:
+        # real-machine runs go one at a time through this process: the IBM
+        # account is loaded once and a single job waits in the device queue
+        yield from map(run_seeded_bb84, tasks)
+        return
+
+    with Pool(workers, maxtasksperchild=RUNS_PER_WORKER) as pool:
+        yield from pool.imap(run_seeded_bb84, tasks)
+
+
+def run_experiment(runs=200, workers=None, simulator=True, accuracy=100, size=5, spy=True, seed=None):
+    workers = workers or os.cpu_count()
+    seed_sequences = np.random.SeedSequence(seed).spawn(runs)
+    tasks = [(run_id, seed_sequences[run_id], seed is not None, simulator, accuracy, size, spy) for run_id in range(runs)]
+    output_name = get_output_name(simulator, spy)
+
+    # the workers only simulate; this process is the single writer
+    with ResultsWriter(f"results_{output_name}", size) as writer:
+        for run_id, keys, circuit in run_tasks(tasks, workers, simulator):
+            writer.append(run_id, keys, simulator, accuracy, spy)
+            if circuit is not None:
+                save_circuit_image(circuit, f"bb84_circuit_{output_name}")
+
+
+def run_batched_experiment(runs=200, simulator=True, accuracy=100, size=5, spy=True, parallel_experiments=0, seed=None):
+    seed_run(np.random.SeedSequence(seed), seed is not None)
+
+    # every run's circuit goes into one job for Eve and one job for Bob
+    runs_keys, circuit = run_bb84_batch(runs, simulator, accuracy, size, spy, parallel_experiments)
+    output_name = get_output_name(simulator, spy)
+
+    with ResultsWriter(f"results_{output_name}", size) as writer:
+        for run_id in range(runs):
+            writer.append(run_id, runs_keys[run_id], simulator, accuracy, spy)
+
+    save_circuit_image(circuit, f"bb84_circuit_{output_name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run BB84 attack experiments in parallel.")
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--real-machine", action="store_true")
+    parser.add_argument("--no-eve", action="store_true")
+    parser.add_argument("--accuracy", type=int, default=100)
+    parser.add_argument("--size", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--batch", action="store_true", help="submit all runs as one job instead of a process pool")
+    parser.add_argument("--parallel-experiments", type=int, default=0)
+    parser.add_argument("--entropy", choices=[CIRCUIT_ENTROPY, QRNG_ENTROPY, CSPRNG_ENTROPY], default=ENTROPY_SOURCE)
+    args = parser.parse_args()
+
+    # forked workers inherit the source and fill their own pools
+    set_entropy_source(args.entropy)
+
+    if args.batch:
+        run_batched_experiment(
+            runs=args.runs,
+            simulator=not args.real_machine,
+            accuracy=args.accuracy,
+            size=args.size,
+            spy=not args.no_eve,
+            parallel_experiments=args.parallel_experiments,
+            seed=args.seed
+        )
+        return
+
+    run_experiment(
+        runs=args.runs,
+        workers=args.workers,
+        simulator=not args.real_machine,
+        accuracy=args.accuracy,
+        size=args.size,
+        spy=not args.no_eve,
+        seed=args.seed
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,19 @@
 from helpers import *
-from qiskit import IBMQ
 
-def bb84(simulator=True, accuracy=100, size=5, spy=True):
+def sift_keys(alice_bits, alice_bases, bob_measurements, bob_bases, eve_measurements=None):
+    # sifting runs on packed keys; the result files keep "0"/"1" lists
+    alice_key = PackedKey.from_bits(alice_bits, alice_bases)
+    bob_key = PackedKey.from_bits(bob_measurements, bob_bases)
+    same_bases = alice_key.same_bases(bob_key)
+
+    keys = {"alice": alice_key.select(same_bases).to_bits(), "bob": bob_key.select(same_bases).to_bits()}
+    if eve_measurements is not None:
+        keys["eve"] = PackedKey.from_bits(eve_measurements).select(same_bases).to_bits()
+
+    return keys
+
+
+def run_bb84(simulator=True, accuracy=100, size=5, spy=True):
     shots = 8192
 
     alice_bits = get_random_sequence_of_bits(size)
@@ -10,17 +22,7 @@ def bb84(simulator=True, accuracy=100, size=5, spy=True):
     
 
     alice_states = get_states(alice_bits, alice_bases)
-    circuit = QuantumCircuit(size, size)
-    initialize_circuit_with_zeros(circuit)
-    insert_states_in_circuit(circuit, alice_states)
-
-
-    if simulator:
-        backend = QasmSimulator()
-    else:
-        print("Loading IBM account")
-        my_provider = IBMQ.load_account()
-        backend = my_provider.get_backend('ibmq_manila')
+    backend = get_pooled_backend(simulator)
 
     # Eve makes measurements
     if spy:
@@ -28,41 +30,60 @@ def bb84(simulator=True, accuracy=100, size=5, spy=True):
     else:
         eve_bases = alice_bases
 
-    insert_measurements_according_to_base(eve_bases, circuit)
-    circuit.barrier()
-    eve_measurements = get_measurements_result(backend, circuit, shots, accuracy, size)
+    circuit = bind_bb84_template(backend, alice_states, eve_bases)
+    eve_measurements = get_template_measurements_result(backend, circuit, shots, accuracy, size)
     eve_states_for_bob = get_states(eve_measurements, eve_bases)
-    initialize_circuit_with_zeros(circuit)
-    insert_states_in_circuit(circuit, eve_states_for_bob)
 
-    insert_measurements_according_to_base(bob_bases, circuit)
-    bob_measurements = get_measurements_result(backend, circuit, shots, accuracy, size)
+    circuit = bind_bb84_template(backend, eve_states_for_bob, bob_bases)
+    bob_measurements = get_template_measurements_result(backend, circuit, shots, accuracy, size)
 
-    same_bases_positions = get_same_bases_positions(alice_bases, bob_bases)
+    keys = sift_keys(alice_bits, alice_bases, bob_measurements, bob_bases, eve_measurements if spy else None)
+    keys.update({"alice_bases": alice_bases, "bob_bases": bob_bases})
+    if spy:
+        keys["eve_bases"] = eve_bases
 
-    alice_sifted_key = discard_different_positions(alice_bits, same_bases_positions)
-    bob_sifted_key = discard_different_positions(bob_measurements, same_bases_positions)
+    return keys, circuit
 
-    if spy:
-        eve_sifted_key = discard_different_positions(eve_measurements, same_bases_positions)
 
-    if simulator:
-        if spy:
-            file = open("data_collected_with_simulator_and_eve.txt", "a")
-            save_circuit_image(circuit, "bb84_circuit_with_simulator_and_eve")
-        else:
-            file = open("data_collected_with_simulator_without_eve.txt", "a")
-            save_circuit_image(circuit, "bb84_circuit_with_simulator_without_eve")
+def run_bb84_batch(runs, simulator=True, accuracy=100, size=5, spy=True, parallel_experiments=0):
+    shots = 8192
+    # Aer runs up to this many experiments of the job at once, 0 uses every core
+    simulator_options = {"max_parallel_experiments": parallel_experiments}
+
+    alice_bits = get_random_sequences_of_bits(size, runs)
+    alice_bases = get_random_sequences_of_bases(size, runs)
+    bob_bases = alice_bases
+
+    alice_states = [get_states(alice_bits[i], alice_bases[i]) for i in range(runs)]
+    backend = get_pooled_backend(simulator)
+
+    # Eve makes measurements
+    if spy:
+        eve_bases = get_random_sequences_of_bases(size, runs)
     else:
+        eve_bases = alice_bases
+
+    circuits = [bind_bb84_template(backend, alice_states[i], eve_bases[i]) for i in range(runs)]
+    eve_measurements = get_batch_measurements_result(backend, circuits, shots, accuracy, size, simulator_options)
+    eve_states_for_bob = [get_states(eve_measurements[i], eve_bases[i]) for i in range(runs)]
+
+    circuits = [bind_bb84_template(backend, eve_states_for_bob[i], bob_bases[i]) for i in range(runs)]
+    bob_measurements = get_batch_measurements_result(backend, circuits, shots, accuracy, size, simulator_options)
+
+    runs_keys = []
+
+    for i in range(runs):
+        keys = sift_keys(alice_bits[i], alice_bases[i], bob_measurements[i], bob_bases[i], eve_measurements[i] if spy else None)
+        keys.update({"alice_bases": alice_bases[i], "bob_bases": bob_bases[i]})
         if spy:
-            file = open("data_collected_with_real_machine_and_eve.txt", "a")
-            save_circuit_image(circuit, "bb84_circuit_with_real_machine_and_eve")
-        else:
-            file = open("data_collected_with_real_machine_without_eve.txt", "a")
-            save_circuit_image(circuit, "bb84_circuit_with_real_machine_without_eve")
+            keys["eve_bases"] = eve_bases[i]
 
-    file.write(f"alice key: {alice_sifted_key}\n")
-    if spy:
-        file.write(f"eve key:   {eve_sifted_key}\n")
-    file.write(f"bob key:   {bob_sifted_key}\n")
-    file.close()
\ No newline at end of file
+        runs_keys.append(keys)
+
+    return runs_keys, circuits[0]
+
+def get_output_name(simulator, spy):
+    machine = "simulator" if simulator else "real_machine"
+    eve = "and_eve" if spy else "without_eve"
+
+    return f"with_{machine}_{eve}"
@@ -1,28 +1,16 @@
-from qiskit import QuantumCircuit, transpile
+from qiskit import IBMQ, QuantumCircuit, transpile
 from qiskit.providers.aer import QasmSimulator
 from qiskit.tools.monitor import job_monitor
 from qiskit.tools.visualization import circuit_drawer
-from random import randint
+import numpy as np
+import os
+import secrets
+import threading
 from constants import *
-from random import randint
 
 
 def get_random_sequence_of_bits(size):
-    simulator = QasmSimulator()
-    circuit = QuantumCircuit(size, size)
-
-    for i in range(size):
-        circuit.h([i])
-        circuit.measure([i], [i])
-
-    compiled_circuit = transpile(circuit, simulator)
-    job = simulator.run(compiled_circuit, shots=1)
-    job_monitor(job)
-    result = job.result()
-    counts = result.get_counts(circuit)
-    str_sequence = next(iter(counts))
-
-    return list(str_sequence)
+    return array_to_bits(get_entropy_pool().take(size))
 
 
 def get_random_sequence_of_bases(size):
@@ -32,6 +20,18 @@ def get_random_sequence_of_bases(size):
     return bases
 
 
+def get_random_sequences_of_bits(size, count):
+    bits = get_entropy_pool().take(size * count).reshape(count, size)
+
+    return [array_to_bits(row) for row in bits]
+
+
+def get_random_sequences_of_bases(size, count):
+    bit_sequences = get_random_sequences_of_bits(size, count)
+
+    return [[Z_BASE if bit == BIT_0 else X_BASE for bit in bit_sequence] for bit_sequence in bit_sequences]
+
+
 def get_state(bit, base):
     if bit == BIT_0:
         if base == Z_BASE:
@@ -46,13 +46,9 @@ def get_state(bit, base):
 
 
 def get_states(bits, bases):
-    states = []
-
-    for i in range(len(bits)):
-        state = get_state(bits[i], bases[i])
-        states.append(state)
+    states = bits_to_array(bits) | (bases_to_mask(bases).astype(np.uint8) << 1)
 
-    return states
+    return STATES_TABLE[states].tolist()
 
 
 
@@ -92,60 +88,146 @@ def insert_measurements_according_to_base(bases, circuit):
             measure_in_x(circuit, i)
 
 
+def is_clifford_circuit(circuits):
+    if isinstance(circuits, QuantumCircuit):
+        circuits = [circuits]
+
+    for circuit in circuits:
+        for name in circuit.count_ops():
+            if name not in CLIFFORD_INSTRUCTIONS:
+                return False
+
+    return True
+
+
+def get_simulation_methods(circuits):
+    if isinstance(circuits, QuantumCircuit):
+        circuits = [circuits]
+
+    if is_clifford_circuit(circuits):
+        return [STABILIZER_METHOD, MPS_METHOD, STATEVECTOR_METHOD]
+
+    if max(circuit.num_qubits for circuit in circuits) > MAX_STATEVECTOR_QUBITS:
+        return [MPS_METHOD, STATEVECTOR_METHOD]
+
+    return [STATEVECTOR_METHOD]
+
+
+# printed once per circuit shape: the entropy pool refills in the background
+# with the same circuits, and a line per job would interleave with the prompts
+REPORTED_SIMULATION_METHODS = set()
+
+
+def report_simulation_method(circuits, message):
+    if isinstance(circuits, QuantumCircuit):
+        circuits = [circuits]
+
+    shape = (
+        message,
+        max(circuit.num_qubits for circuit in circuits),
+        frozenset(name for circuit in circuits for name in circuit.count_ops())
+    )
+    if shape not in REPORTED_SIMULATION_METHODS:
+        REPORTED_SIMULATION_METHODS.add(shape)
+        print(message)
+
+
+def compile_circuits(circuits, backend):
+    if not isinstance(backend, QasmSimulator):
+        return transpile(circuits, backend)
+
+    # level 0 keeps the X/H/CX gates, higher levels may merge them into U gates
+    return transpile(circuits, backend, optimization_level=0)
+
+
+def run_circuits(circuits, backend, shots):
+    compiled_circuits = compile_circuits(circuits, backend)
+
+    return run_compiled_circuits(compiled_circuits, backend, shots)
+
+
+# set by seed_simulator_jobs for reproducible runs; None leaves Aer unseeded
+SIMULATOR_SETTINGS = {"seeds": None}
+
+
+def seed_simulator_jobs(seed):
+    SIMULATOR_SETTINGS["seeds"] = np.random.default_rng(seed)
+
+
+def run_compiled_circuits(compiled_circuits, backend, shots, memory=False, simulator_options=None):
+    if not isinstance(backend, QasmSimulator):
+        job = backend.run(compiled_circuits, shots=shots, memory=memory)
+        job_monitor(job)
+        return job.result()
+
+    simulator_options = dict(simulator_options or {})
+    if SIMULATOR_SETTINGS["seeds"] is not None:
+        simulator_options["seed_simulator"] = int(SIMULATOR_SETTINGS["seeds"].integers(1 << 31))
+
+    for method in get_simulation_methods(compiled_circuits):
+        job = backend.run(compiled_circuits, shots=shots, memory=memory, method=method, **simulator_options)
+        job_monitor(job)
+        result = job.result()
+
+        if result.success:
+            report_simulation_method(compiled_circuits, f"Simulation method: {method}")
+            return result
+
+        report_simulation_method(compiled_circuits, f"Simulation method {method} failed, falling back")
+
+    return result
+
+
 def get_counts(circuit, backend, shots):
-    compiled_circuit = transpile(circuit, backend)
-    job = backend.run(compiled_circuit, shots=shots)
-    job_monitor(job)
-    result = job.result()
+    result = run_circuits(circuit, backend, shots)
     counts = result.get_counts(circuit)
 
     return counts
 
 
-def get_measurements_result(backend, circuit, shots, accuracy, size):
-    measurements = []
-    counts = get_counts(circuit, backend, shots)
-    value_list = counts.items()
-
-    for i in range(size):
-        zeros = 0
-        ones = 0
-
-        for (key, value) in value_list:
-            if key[i] == BIT_1:
-                ones += value
-            elif key[i] == BIT_0:
-                zeros += value
-
-        if ones > zeros:
-            if ones * 100 / shots >= accuracy:
-                measurements.append(BIT_1)
-            else:
-                random_number = str(randint(0, 1))
-                measurements.append(random_number)
-        elif zeros >= ones:
-            if zeros * 100 / shots >= accuracy:
-                measurements.append(BIT_0)
-            else:
-                random_number = str(randint(0, 1))
-                measurements.append(random_number)
+def get_outcomes_matrix(bitstrings):
+    # one row per bitstring, one column per character (qiskit prints the last qubit first)
+    characters = np.frombuffer("".join(bitstrings).encode(), dtype=np.uint8)
+
+    return (characters.reshape(len(bitstrings), -1) == ord(BIT_1)).astype(np.int64)
+
+
+def get_ones_counts(counts):
+    outcomes = get_outcomes_matrix(list(counts.keys()))
+    frequencies = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+
+    return frequencies @ outcomes
+
+
+def decide_measurements(ones, shots, accuracy):
+    zeros = shots - ones
+    bits = (ones > zeros).astype(np.uint8)
+    majority = np.where(bits == 1, ones, zeros)
+    random_bits = np.random.randint(0, 2, size=len(bits)).astype(np.uint8)
+
+    return array_to_bits(np.where(majority * 100 / shots >= accuracy, bits, random_bits))
+
+
+def get_measurements_from_counts(counts, shots, accuracy, size):
+    ones = get_ones_counts(counts)[:size]
+    measurements = decide_measurements(ones, shots, accuracy)
 
     measurements.reverse()
     return measurements
 
 
-def get_same_bases_positions(first_bases, second_bases):
-    positions = []
-    bases_length = len(first_bases)
+def get_measurements_from_memory(memory, accuracy, size):
+    ones = get_outcomes_matrix(memory).sum(axis=0)[:size]
+    measurements = decide_measurements(ones, len(memory), accuracy)
+
+    measurements.reverse()
+    return measurements
 
-    for i in range(bases_length):
-        first_base = first_bases[i]
-        second_base = second_bases[i]
 
-        if first_base == second_base:
-            positions.append(i)
+def get_measurements_result(backend, circuit, shots, accuracy, size):
+    counts = get_counts(circuit, backend, shots)
 
-    return positions
+    return get_measurements_from_counts(counts, shots, accuracy, size)
 
 
 def save_circuit_image(circuit, file_name):
@@ -153,17 +235,294 @@ def save_circuit_image(circuit, file_name):
         circuit, output="mpl", style={"backgroundcolor": "#EEEEEE"}
     )
     diagram.savefig(f"{file_name}.png", format="png")
-
-
-def discard_different_positions(arr, correct_positions):
-    corrected_array = []
-
-    for i in correct_positions:
-        corrected_array.append(arr[i])
-
-    return corrected_array
         
         
 def initialize_circuit_with_zeros(circuit):
     for i in range(circuit.num_qubits):
-        circuit.reset(i)
\ No newline at end of file
+        circuit.reset(i)
+
+# packed keys
+POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1)
+
+STATES_TABLE = np.array([STATE_0, STATE_1, STATE_PLUS, STATE_MINUS])
+
+
+def bits_to_array(bits):
+    return (np.asarray(bits) == BIT_1).astype(np.uint8)
+
+
+def array_to_bits(array):
+    return np.where(array == 1, BIT_1, BIT_0).tolist()
+
+
+def bases_to_mask(bases):
+    return np.asarray(bases) == X_BASE
+
+
+class PackedKey:
+    """
+    Key bits packed eight per byte, plus the basis of every bit as a boolean
+    mask (True for X), with conversions from and to "0"/"1" lists.
+    """
+
+    def __init__(self, packed_bits, length, basis_mask=None):
+        self.packed_bits = packed_bits
+        self.length = length
+        self.basis_mask = basis_mask
+
+    @classmethod
+    def from_array(cls, array, basis_mask=None):
+        return cls(np.packbits(np.asarray(array, dtype=np.uint8)), len(array), basis_mask)
+
+    @classmethod
+    def from_bits(cls, bits, bases=None):
+        basis_mask = None if bases is None else bases_to_mask(list(bases))
+        return cls.from_array(bits_to_array(list(bits)), basis_mask)
+
+    def __len__(self):
+        return self.length
+
+    def unpack(self):
+        return np.unpackbits(self.packed_bits, count=self.length)
+
+    def to_bits(self):
+        return array_to_bits(self.unpack())
+
+    def to_bytes(self):
+        return self.packed_bits.tobytes()
+
+    def select(self, mask):
+        basis_mask = None if self.basis_mask is None else self.basis_mask[mask]
+        return PackedKey.from_array(self.unpack()[mask], basis_mask)
+
+    def same_bases(self, other):
+        return self.basis_mask == other.basis_mask
+
+    def count_errors(self, other):
+        # padding bits are zero in both keys, so they never count as errors
+        different_bits = np.bitwise_xor(self.packed_bits, other.packed_bits)
+        return int(POPCOUNT_TABLE[different_bits].sum())
+
+
+# circuit templates
+# per-qubit gates, indexed by the prepared state and by the measurement basis;
+# X and H only, so every BB84 template is a Clifford circuit for the stabilizer
+PREPARATION_GATES = {STATE_0: (), STATE_1: ("x",), STATE_PLUS: ("h",), STATE_MINUS: ("x", "h")}
+MEASUREMENT_GATES = {Z_BASE: (), X_BASE: ("h",)}
+# run_compiled_circuits only routes Clifford gate sets to the stabilizer method
+assert all(gate in CLIFFORD_INSTRUCTIONS for gates in [*PREPARATION_GATES.values(), *MEASUREMENT_GATES.values()] for gate in gates)
+BACKEND_POOL = {}
+TEMPLATES = {}
+COMPILED_TEMPLATES = {}
+
+
+def get_pooled_backend(simulator):
+    if simulator not in BACKEND_POOL:
+        if simulator:
+            BACKEND_POOL[simulator] = QasmSimulator()
+        else:
+            print("Loading IBM account")
+            my_provider = IBMQ.load_account()
+            BACKEND_POOL[simulator] = my_provider.get_backend('ibmq_manila')
+
+    return BACKEND_POOL[simulator]
+
+
+def build_random_template(size):
+    circuit = QuantumCircuit(size, size)
+    circuit.h(range(size))
+    circuit.measure(range(size), range(size))
+
+    return circuit
+
+
+def build_bb84_template(size):
+    # the part every run shares; bind_bb84_template adds the run's gates
+    circuit = QuantumCircuit(size, size)
+    initialize_circuit_with_zeros(circuit)
+
+    return circuit
+
+
+def get_template(protocol, size):
+    if (protocol, size) not in TEMPLATES:
+        if protocol == RANDOM_TEMPLATE:
+            TEMPLATES[(protocol, size)] = build_random_template(size)
+        elif protocol == BB84_TEMPLATE:
+            TEMPLATES[(protocol, size)] = build_bb84_template(size)
+
+    return TEMPLATES[(protocol, size)]
+
+
+def get_compiled_template(protocol, size, backend):
+    # backends come from the pool, so the object itself identifies the backend
+    if (protocol, size, backend) not in COMPILED_TEMPLATES:
+        template = get_template(protocol, size)
+        COMPILED_TEMPLATES[(protocol, size, backend)] = compile_circuits(template, backend)
+
+    return COMPILED_TEMPLATES[(protocol, size, backend)]
+
+
+def bind_bb84_template(backend, states, bases):
+    circuit = get_template(BB84_TEMPLATE, len(states)).copy()
+
+    for i in range(len(states)):
+        for gate in PREPARATION_GATES[states[i]]:
+            getattr(circuit, gate)(i)
+
+    circuit.barrier()
+
+    for i in range(len(bases)):
+        for gate in MEASUREMENT_GATES[bases[i]]:
+            getattr(circuit, gate)(i)
+        circuit.measure([i], [i])
+
+    # Aer runs x and h natively, only a real device maps them to its own gates
+    if not isinstance(backend, QasmSimulator):
+        return compile_circuits(circuit, backend)
+
+    return circuit
+
+
+def get_template_measurements_result(backend, bound_circuit, shots, accuracy, size):
+    result = run_compiled_circuits(bound_circuit, backend, shots)
+    counts = result.get_counts(0)
+
+    return get_measurements_from_counts(counts, shots, accuracy, size)
+
+
+def get_batch_measurements_result(backend, bound_circuits, shots, accuracy, size, simulator_options=None):
+    result = run_compiled_circuits(bound_circuits, backend, shots, simulator_options=simulator_options)
+    measurements = []
+
+    for i in range(len(bound_circuits)):
+        counts = result.get_counts(i)
+        measurements.append(get_measurements_from_counts(counts, shots, accuracy, size))
+
+    return measurements
+
+# entropy pool
+def memory_to_array(memory):
+    return np.frombuffer("".join(memory).encode(), dtype=np.uint8) - ord(BIT_0)
+
+
+def get_circuit_entropy(size):
+    # the random template circuit, one shot per ENTROPY_CIRCUIT_WIDTH bits
+    simulator = get_pooled_backend(True)
+    compiled_circuit = get_compiled_template(RANDOM_TEMPLATE, ENTROPY_CIRCUIT_WIDTH, simulator)
+    shots = -(-size // ENTROPY_CIRCUIT_WIDTH)
+
+    result = run_compiled_circuits(compiled_circuit, simulator, shots, memory=True)
+
+    return memory_to_array(result.get_memory(0))[:size]
+
+
+def get_qrng_entropy(size):
+    # a single Hadamard qubit, measured once per shot
+    simulator = get_pooled_backend(True)
+    compiled_circuit = get_compiled_template(RANDOM_TEMPLATE, 1, simulator)
+
+    result = run_compiled_circuits(compiled_circuit, simulator, size, memory=True)
+
+    return memory_to_array(result.get_memory(0))
+
+
+def get_csprng_entropy(size):
+    random_bytes = np.frombuffer(secrets.token_bytes(-(-size // 8)), dtype=np.uint8)
+
+    return np.unpackbits(random_bytes)[:size]
+
+
+ENTROPY_SOURCES = {
+    CIRCUIT_ENTROPY: get_circuit_entropy,
+    QRNG_ENTROPY: get_qrng_entropy,
+    CSPRNG_ENTROPY: get_csprng_entropy,
+}
+
+
+class EntropyPool:
+    """Random bits drawn from a source in large batches, refilled on a background thread."""
+
+    def __init__(self, source=ENTROPY_SOURCE, capacity=ENTROPY_POOL_SIZE, refill_threshold=ENTROPY_REFILL_THRESHOLD, seed=None):
+        self.source = ENTROPY_SOURCES[source]
+        if seed is not None:
+            # a seeded generator stands in for the source, so a run can be repeated
+            rng = np.random.default_rng(seed)
+            self.source = lambda size: rng.integers(0, 2, size, dtype=np.uint8)
+        self.capacity = capacity
+        self.refill_threshold = refill_threshold
+        self.buffer = np.empty(0, dtype=np.uint8)
+        self.position = 0
+        self.next_buffer = None
+        self.refill_thread = None
+        self.lock = threading.Lock()
+        self.start_refill()
+
+    def available(self):
+        return len(self.buffer) - self.position
+
+    def refill(self):
+        self.next_buffer = self.source(self.capacity)
+
+    def start_refill(self):
+        if self.refill_thread is None:
+            self.refill_thread = threading.Thread(target=self.refill, daemon=True)
+            self.refill_thread.start()
+
+    def swap_buffers(self):
+        self.start_refill()
+        self.refill_thread.join()
+        self.refill_thread = None
+
+        # a failed background refill is retried here, so its error reaches the caller
+        if self.next_buffer is None:
+            self.refill()
+
+        self.buffer, self.position, self.next_buffer = self.next_buffer, 0, None
+
+    def take(self, size):
+        chunks = [np.empty(0, dtype=np.uint8)]
+
+        with self.lock:
+            while size > 0:
+                if self.available() == 0:
+                    self.swap_buffers()
+
+                chunk = self.buffer[self.position:self.position + size]
+                self.position += len(chunk)
+                size -= len(chunk)
+                chunks.append(chunk)
+
+            # the next batch is prepared while the protocol uses this one
+            if self.available() < self.refill_threshold:
+                self.start_refill()
+
+        return np.concatenate(chunks)
+
+
+ENTROPY_SETTINGS = {"source": ENTROPY_SOURCE, "seed": None}
+ENTROPY_POOLS = {}
+
+
+def set_entropy_source(source):
+    if source not in ENTROPY_SOURCES:
+        raise ValueError(f"Unknown entropy source: {source}")
+
+    ENTROPY_SETTINGS["source"] = source
+
+
+def seed_entropy_pool(seed):
+    # the next pool starts from the seed, so a reused worker never hands out
+    # bits buffered during an earlier run
+    ENTROPY_SETTINGS["seed"] = seed
+    ENTROPY_POOLS.pop((os.getpid(), ENTROPY_SETTINGS["source"]), None)
+
+
+def get_entropy_pool():
+    # keyed by process too, so forked workers never reuse their parent's buffer
+    key = (os.getpid(), ENTROPY_SETTINGS["source"])
+
+    if key not in ENTROPY_POOLS:
+        ENTROPY_POOLS[key] = EntropyPool(ENTROPY_SETTINGS["source"], seed=ENTROPY_SETTINGS["seed"])
+
+    return ENTROPY_POOLS[key]
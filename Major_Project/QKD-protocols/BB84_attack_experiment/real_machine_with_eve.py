@@ -1,5 +1,5 @@
-from bb84 import bb84
+from batch_runner import run_experiment
 
 
-for i in range(200):
-  bb84(simulator=False, accuracy=95, spy=True)
\ No newline at end of file
+if __name__ == "__main__":
+  run_experiment(runs=200, simulator=False, accuracy=95, spy=True)
\ No newline at end of file
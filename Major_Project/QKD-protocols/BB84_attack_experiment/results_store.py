@@ -0,0 +1,139 @@
+from constants import *
+import numpy as np
+import os
+import struct
+import zipfile
+
+KEY_NAMES = ["alice", "eve", "bob"]
+RECORDS_PER_SHARD = 1000
+
+
+def pack_bits(bits, size):
+    # rows have a fixed width, so keys shorter than size are padded with zeros
+    row = np.zeros(size, dtype=np.uint8)
+    row[:len(bits)] = np.asarray(bits) == BIT_1
+
+    return np.packbits(row)
+
+
+def pack_bases(bases, size):
+    return pack_bits([BIT_1 if base == X_BASE else BIT_0 for base in bases], size)
+
+
+def unpack_bits(packed_rows, lengths):
+    rows = np.unpackbits(packed_rows, axis=1)
+
+    return [rows[i, :lengths[i]] for i in range(len(lengths))]
+
+
+def get_qber(alice_key, bob_key):
+    if len(alice_key) == 0:
+        return np.nan
+
+    errors = sum(1 for alice_bit, bob_bit in zip(alice_key, bob_key) if alice_bit != bob_bit)
+    return errors / len(alice_key)
+
+
+class ResultsWriter:
+    """Buffers experiment records and writes them as columnar .npz shards."""
+
+    def __init__(self, directory, size, records_per_shard=RECORDS_PER_SHARD):
+        self.directory = directory
+        self.size = size
+        self.records_per_shard = records_per_shard
+        self.records = []
+        os.makedirs(directory, exist_ok=True)
+        self.shard_index = len(get_shard_paths(directory))
+        # run ids continue after the records already stored in the directory
+        self.first_run_id = sum(len(shard["run_id"]) for shard in iter_shards(directory))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, run_id, keys, simulator, accuracy, spy):
+        self.records.append((run_id, keys, simulator, accuracy, spy))
+
+        if len(self.records) >= self.records_per_shard:
+            self.flush()
+
+    def flush(self):
+        if not self.records:
+            return
+
+        runs_keys = [record[1] for record in self.records]
+        columns = {
+            "run_id": self.first_run_id + np.array([record[0] for record in self.records], dtype=np.int64),
+            "simulator": np.array([record[2] for record in self.records], dtype=bool),
+            "accuracy": np.array([record[3] for record in self.records], dtype=np.int16),
+            "spy": np.array([record[4] for record in self.records], dtype=bool),
+            "size": np.full(len(self.records), self.size, dtype=np.int16),
+            "qber": np.array([get_qber(keys["alice"], keys["bob"]) for keys in runs_keys]),
+            "key_length": np.array([len(keys["alice"]) for keys in runs_keys], dtype=np.int16),
+        }
+
+        for name in KEY_NAMES:
+            # without Eve her bases and key are left as zero rows
+            columns[f"{name}_bases"] = np.stack([
+                pack_bases(keys.get(f"{name}_bases", []), self.size) for keys in runs_keys
+            ])
+            columns[f"{name}_key"] = np.stack([
+                pack_bits(keys.get(name, []), self.size) for keys in runs_keys
+            ])
+
+        # np.savez stores the members uncompressed, which is what lets the reader memory-map them
+        np.savez(os.path.join(self.directory, f"shard_{self.shard_index:05d}.npz"), **columns)
+        self.shard_index += 1
+        self.records = []
+
+    def close(self):
+        self.flush()
+
+
+def get_shard_paths(directory):
+    if not os.path.isdir(directory):
+        return []
+
+    names = sorted(name for name in os.listdir(directory) if name.startswith("shard_") and name.endswith(".npz"))
+    return [os.path.join(directory, name) for name in names]
+
+
+def memmap_shard(path):
+    columns = {}
+
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as file:
+        for info in archive.infolist():
+            # the local file header is 30 bytes followed by the name and extra fields
+            file.seek(info.header_offset)
+            name_length, extra_length = struct.unpack("<HH", file.read(30)[26:30])
+            file.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+
+            name = info.filename[:-len(".npy")]
+            if 0 in shape:
+                columns[name] = np.empty(shape, dtype=dtype)
+            else:
+                columns[name] = np.memmap(path, dtype=dtype, mode="r", offset=file.tell(), shape=shape,
+                                          order="F" if fortran_order else "C")
+
+    return columns
+
+
+def iter_shards(directory):
+    for path in get_shard_paths(directory):
+        yield memmap_shard(path)
+
+
+def load_results(directory):
+    shards = list(iter_shards(directory))
+    if not shards:
+        return {}
+
+    return {name: np.concatenate([shard[name] for shard in shards]) for name in shards[0]}
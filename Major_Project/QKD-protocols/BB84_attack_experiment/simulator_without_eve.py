@@ -1,5 +1,5 @@
-from bb84 import bb84
+from batch_runner import run_experiment
 
 
-for i in range(1):
-  bb84(simulator=True, accuracy=100, spy=False, size=5)
\ No newline at end of file
+if __name__ == "__main__":
+  run_experiment(runs=1, simulator=True, accuracy=100, spy=False, size=5)
\ No newline at end of file
@@ -1,13 +1,14 @@
 from helpers import *
 from qiskit import IBMQ
 
-def e91():
+def e91(entropy_source=ENTROPY_SOURCE):
   use_simulator = input("Run using simulator?(y/n): ").lower()
   shots = 1
   backend = QasmSimulator()
   accuracy = 100
 
   number_of_pairs = int(input("Enter desired number of entangled pairs (max:14): "))
+  set_entropy_source(entropy_source)
   alice_bases = get_random_sequence_of_bases(number_of_pairs)
   bob_bases = get_random_sequence_of_bases(number_of_pairs)
     
@@ -32,13 +33,16 @@ def e91():
   save_circuit_image(circuit, "e91_circuit_without_eve")
 
   measurements = get_measurements_result(backend, circuit, shots, accuracy, number_of_qubits)
-  same_bases_positions = get_same_bases_positions(alice_bases, bob_bases)
-
   alice_measurements = measurements['alice']
   bob_measurements = measurements['bob']
 
-  alice_sifted_key = discard_different_positions(alice_measurements, same_bases_positions)
-  bob_sifted_key = discard_different_positions(bob_measurements, same_bases_positions)
+  alice_key = PackedKey.from_bits(alice_measurements, alice_bases)
+  bob_key = PackedKey.from_bits(bob_measurements, bob_bases)
+  same_bases = alice_key.same_bases(bob_key)
+  same_bases_positions = np.flatnonzero(same_bases).tolist()
+
+  alice_sifted_key = alice_key.select(same_bases)
+  bob_sifted_key = bob_key.select(same_bases)
   
   print('\n')
   print("E91 protocol without intervention\n")
@@ -49,12 +53,12 @@ def e91():
   print("bob measurements:   ", bob_measurements)
   print("same_bases_positions: ", same_bases_positions)
   print('\n')
-  print("alice_sifted_key", alice_sifted_key)
-  print("bob_sifted_key  ", bob_sifted_key)
+  print("alice_sifted_key", alice_sifted_key.to_bits())
+  print("bob_sifted_key  ", bob_sifted_key.to_bits())
 
   privacy_amplification = input("Perform privacy amplification?(y/n): ").lower()
   if privacy_amplification == "y":
-      perform_privacy_amplification(alice_sifted_key, bob_sifted_key)
+      alice_sifted_key, bob_sifted_key = perform_privacy_amplification(alice_sifted_key, bob_sifted_key)
 
   encrypt = input("Encrypt message?(y/n): ").lower()
   if encrypt == "y":
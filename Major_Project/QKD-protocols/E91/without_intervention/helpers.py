@@ -2,28 +2,19 @@ from qiskit import QuantumCircuit, transpile
 from qiskit.providers.aer import QasmSimulator
 from qiskit.tools.monitor import job_monitor
 from qiskit.tools.visualization import circuit_drawer
-from random import randint, sample
+from math import floor, log2
+from random import sample
 from constants import *
 from onetimepad import decrypt, encrypt
+import numpy as np
+import os
+import secrets
 import sys
+import threading
 
 
 def get_random_sequence_of_bits(number_of_pairs):
-    simulator = QasmSimulator()
-    circuit = QuantumCircuit(number_of_pairs, number_of_pairs)
-
-    for i in range(number_of_pairs):
-        circuit.h([i])
-        circuit.measure([i], [i])
-
-    compiled_circuit = transpile(circuit, simulator)
-    job = simulator.run(compiled_circuit, shots=1)
-    job_monitor(job)
-    result = job.result()
-    counts = result.get_counts(circuit)
-    str_sequence = next(iter(counts))
-
-    return list(str_sequence)
+    return array_to_bits(get_entropy_pool().take(number_of_pairs))
 
 
 def get_random_sequence_of_bases(number_of_pairs):
@@ -77,118 +68,230 @@ def save_circuit_image(circuit, file_name):
     diagram.savefig(f"{file_name}.png", format="png")
     
 
+def is_clifford_circuit(circuits):
+    if isinstance(circuits, QuantumCircuit):
+        circuits = [circuits]
+
+    for circuit in circuits:
+        for name in circuit.count_ops():
+            if name not in CLIFFORD_INSTRUCTIONS:
+                return False
+
+    return True
+
+
+def get_simulation_methods(circuits):
+    if isinstance(circuits, QuantumCircuit):
+        circuits = [circuits]
+
+    if is_clifford_circuit(circuits):
+        return [STABILIZER_METHOD, MPS_METHOD, STATEVECTOR_METHOD]
+
+    if max(circuit.num_qubits for circuit in circuits) > MAX_STATEVECTOR_QUBITS:
+        return [MPS_METHOD, STATEVECTOR_METHOD]
+
+    return [STATEVECTOR_METHOD]
+
+
+# printed once per circuit shape: the entropy pool refills in the background
+# with the same circuits, and a line per job would interleave with the prompts
+REPORTED_SIMULATION_METHODS = set()
+
+
+def report_simulation_method(circuits, message):
+    if isinstance(circuits, QuantumCircuit):
+        circuits = [circuits]
+
+    shape = (
+        message,
+        max(circuit.num_qubits for circuit in circuits),
+        frozenset(name for circuit in circuits for name in circuit.count_ops())
+    )
+    if shape not in REPORTED_SIMULATION_METHODS:
+        REPORTED_SIMULATION_METHODS.add(shape)
+        print(message)
+
+
+def run_circuits(circuits, backend, shots, memory=False):
+    if not isinstance(backend, QasmSimulator):
+        compiled_circuits = transpile(circuits, backend)
+        job = backend.run(compiled_circuits, shots=shots, memory=memory)
+        job_monitor(job)
+        return job.result()
+
+    # level 0 keeps the X/H/CX gates, higher levels may merge them into U gates
+    compiled_circuits = transpile(circuits, backend, optimization_level=0)
+
+    for method in get_simulation_methods(circuits):
+        job = backend.run(compiled_circuits, shots=shots, memory=memory, method=method)
+        job_monitor(job)
+        result = job.result()
+
+        if result.success:
+            report_simulation_method(circuits, f"Simulation method: {method}")
+            return result
+
+        report_simulation_method(circuits, f"Simulation method {method} failed, falling back")
+
+    return result
+
+
 def get_counts(circuit, backend, shots):
-    compiled_circuit = transpile(circuit, backend)
-    job = backend.run(compiled_circuit, shots=shots)
-    job_monitor(job)
-    result = job.result()
+    result = run_circuits(circuit, backend, shots)
     counts = result.get_counts(circuit)
 
     return counts
 
 
-def get_measurements_result(backend, circuit, shots, accuracy, number_of_pairs):
-    measurements = []
-    counts = get_counts(circuit, backend, shots)
-    value_list = counts.items()
-
-    for i in range(number_of_pairs):
-        zeros = 0
-        ones = 0
-
-        for (key, value) in value_list:
-            if key[i] == BIT_1:
-                ones += value
-            elif key[i] == BIT_0:
-                zeros += value
-
-        if ones > zeros:
-            if ones * 100 / shots >= accuracy:
-                measurements.append(BIT_1)
-            else:
-                random_number = str(randint(0, 1))
-                measurements.append(random_number)
-        elif zeros >= ones:
-            if zeros * 100 / shots >= accuracy:
-                measurements.append(BIT_0)
-            else:
-                random_number = str(randint(0, 1))
-                measurements.append(random_number)
+def get_outcomes_matrix(bitstrings):
+    # one row per bitstring, one column per character (qiskit prints the last qubit first)
+    characters = np.frombuffer("".join(bitstrings).encode(), dtype=np.uint8)
 
-    measurements.reverse()
+    return (characters.reshape(len(bitstrings), -1) == ord(BIT_1)).astype(np.int64)
 
-    bob_measurements = []
-    alice_measurements = []
 
-    for i in range(len(measurements)):
-        measurement = measurements[i]
-        if i % 2 == 0:
-            alice_measurements.append(measurement)
-        elif i % 2 != 0:
-            bob_measurements.append(measurement)
-            
-    measurements_dic = {"bob":bob_measurements, "alice":alice_measurements}
+def get_ones_counts(counts):
+    outcomes = get_outcomes_matrix(list(counts.keys()))
+    frequencies = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
 
-    return measurements_dic
-    
+    return frequencies @ outcomes
 
-def get_same_bases_positions(first_bases, second_bases):
-    positions = []
-    bases_length = len(first_bases)
 
-    for i in range(bases_length):
-        first_base = first_bases[i]
-        second_base = second_bases[i]
+def decide_measurements(ones, shots, accuracy):
+    zeros = shots - ones
+    bits = (ones > zeros).astype(np.uint8)
+    majority = np.where(bits == 1, ones, zeros)
+    random_bits = np.random.randint(0, 2, size=len(bits)).astype(np.uint8)
 
-        if first_base == second_base:
-            positions.append(i)
+    return array_to_bits(np.where(majority * 100 / shots >= accuracy, bits, random_bits))
 
-    return positions
 
+def get_measurements_from_counts(counts, shots, accuracy, size):
+    ones = get_ones_counts(counts)[:size]
+    measurements = decide_measurements(ones, shots, accuracy)
 
-def discard_different_positions(arr, correct_positions):
-    corrected_array = []
+    measurements.reverse()
+    return measurements
 
-    for i in correct_positions:
-        corrected_array.append(arr[i])
 
-    return corrected_array
+def get_measurements_from_memory(memory, accuracy, size):
+    ones = get_outcomes_matrix(memory).sum(axis=0)[:size]
+    measurements = decide_measurements(ones, len(memory), accuracy)
 
+    measurements.reverse()
+    return measurements
 
-# check_for_eavesdropper
-def perform_privacy_amplification(alice_sifted_key, bob_sifted_key):
+
+def get_measurements_result(backend, circuit, shots, accuracy, number_of_pairs):
+    counts = get_counts(circuit, backend, shots)
+    measurements = get_measurements_from_counts(counts, shots, accuracy, number_of_pairs)
+
+    return split_measurements(measurements)
+
+
+def split_measurements(measurements):
+    # even qubits belong to Alice and odd qubits to Bob
+    measurements_dic = {"bob": measurements[1::2], "alice": measurements[0::2]}
+
+    return measurements_dic
+    
+
+def check_for_eavesdropper(alice_sifted_key, bob_sifted_key):
     max_bits_to_discard = len(alice_sifted_key)
     bits_to_discard = int(input(f"Enter desired number of bits to compare (max:{max_bits_to_discard}): "))
     accuracy = int(input("Enter desired accuracy: "))
-    print("The compared bits will be discarded\n")
 
+    if bits_to_discard == 0:
+        # nothing compared means nothing bounds Eve's knowledge: assume the worst QBER
+        print("Result: No bits compared, the QBER is unknown\n")
+        return alice_sifted_key, bob_sifted_key, 0.5
+
+    print("The compared bits will be discarded\n")
     sequence_length = len(alice_sifted_key)
     random_indexes = sample(range(sequence_length), bits_to_discard)
-    matching_values = 0
 
     random_indexes.sort()
     print(f"Positions of bits checked: {random_indexes}")
 
-    for i in random_indexes:
-        if alice_sifted_key[i] == bob_sifted_key[i]:
-            matching_values += 1
+    checked_positions = np.zeros(sequence_length, dtype=bool)
+    checked_positions[random_indexes] = True
+    errors = alice_sifted_key.select(checked_positions).count_errors(bob_sifted_key.select(checked_positions))
+    matching_values = bits_to_discard - errors
 
     if matching_values * 100 / bits_to_discard >= accuracy:
         print("Result: No eavesdropper detected\n")
 
-        alice_sifted_key = ''
-        bob_sifted_key = ''
-        for i in range(sequence_length):
-            if not i in random_indexes:
-                alice_sifted_key += alice_sifted_key[i]
-                bob_sifted_key += bob_sifted_key[i]
+        alice_sifted_key = alice_sifted_key.select(~checked_positions)
+        bob_sifted_key = bob_sifted_key.select(~checked_positions)
 
-        print(f"Alice's sifted key: {alice_sifted_key}\n")
-        print(f"Bob's sifted key: {bob_sifted_key}\n")
+        print(f"Alice's sifted key: {''.join(alice_sifted_key.to_bits())}\n")
+        print(f"Bob's sifted key: {''.join(bob_sifted_key.to_bits())}\n")
     else:
         print("Result: Eavesdropper detected. Abort protocol.")
         sys.exit(0)
 
+    return alice_sifted_key, bob_sifted_key, errors / bits_to_discard
+
+
+# privacy amplification
+def binary_entropy(p):
+    if p <= 0 or p >= 1:
+        return 0.0
+    return -p * log2(p) - (1 - p) * log2(1 - p)
+
+
+def get_secret_key_length(length, qber, leaked_bits=0, epsilon=PRIVACY_EPSILON):
+    # what Eve may know (n * h(QBER) plus the leaked bits) and a 2 * log2(1 / epsilon) margin
+    secret_length = length * (1 - binary_entropy(qber)) - leaked_bits - 2 * log2(1 / epsilon)
+    return max(0, floor(secret_length))
+
+
+def get_toeplitz_seed(length, output_length, seed):
+    # the same expansion of the public seed as the BB84 encoder's privacy
+    # amplification, so one seed gives one Toeplitz matrix in every folder
+    n_bits = length + output_length - 1
+    seed_bytes = np.random.default_rng(seed).bytes((n_bits + 7) // 8)
+    return np.unpackbits(np.frombuffer(seed_bytes, dtype=np.uint8), count=n_bits)
+
+
+def toeplitz_hash(bits, output_length, seed):
+    # T @ bits mod 2 for the Toeplitz matrix T[i, j] = seed_bits[i - j + n - 1],
+    # computed as an FFT convolution in O(n log n) instead of O(n * m)
+    length = len(bits)
+    if not length or not output_length:
+        return np.zeros(output_length, dtype=np.uint8)
+
+    seed_bits = get_toeplitz_seed(length, output_length, seed)
+    fft_length = 1 << (len(seed_bits) - 1).bit_length()
+
+    spectrum = np.fft.rfft(seed_bits, fft_length) * np.fft.rfft(bits, fft_length)
+    convolution = np.fft.irfft(spectrum, fft_length)[length - 1:length - 1 + output_length]
+
+    return np.rint(convolution).astype(np.int64).astype(np.uint8) & 1
+
+
+def perform_privacy_amplification(alice_sifted_key, bob_sifted_key):
+    alice_sifted_key, bob_sifted_key, qber = check_for_eavesdropper(alice_sifted_key, bob_sifted_key)
+    secret_length = get_secret_key_length(len(alice_sifted_key), qber)
+    # the seed is public, Alice sends it to Bob
+    seed = int(np.random.default_rng().integers(1 << 63))
+
+    print(f"Estimated QBER: {qber:.3f}, secret key length: {secret_length} of {len(alice_sifted_key)} bits")
+    if secret_length == 0:
+        print("The key is too short to keep any secret bits, try a longer one.\n")
+
+    alice_key = "".join(array_to_bits(toeplitz_hash(alice_sifted_key.unpack(), secret_length, seed)))
+    bob_key = "".join(array_to_bits(toeplitz_hash(bob_sifted_key.unpack(), secret_length, seed)))
+
+    print(f"Toeplitz seed: {seed}")
+    print(f"Alice's final key: {alice_key}\n")
+    print(f"Bob's final key: {bob_key}\n")
+    if alice_key != bob_key:
+        print("The final keys differ: the sifted keys need error correction first.\n")
+
+    return alice_key, bob_key
+
+
 def encrypt_message(message):
     encryption_key = input("Enter encryption key: ")
     encrypted_message = encrypt(message, encryption_key)
@@ -203,4 +306,181 @@ def descrypt_message(encrypted_message):
 
 def initialize_circuit_with_zeros(circuit):
     for i in range(circuit.num_qubits):
-        circuit.reset(i)
\ No newline at end of file
+        circuit.reset(i)
+
+# packed keys
+POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1)
+
+
+def bits_to_array(bits):
+    return (np.asarray(bits) == BIT_1).astype(np.uint8)
+
+
+def array_to_bits(array):
+    return np.where(array == 1, BIT_1, BIT_0).tolist()
+
+
+def bases_to_mask(bases):
+    return np.asarray(bases) == X_BASE
+
+
+class PackedKey:
+    """
+    Key bits packed eight per byte, plus the basis of every bit as a boolean
+    mask (True for X), with conversions from and to "0"/"1" lists.
+    """
+
+    def __init__(self, packed_bits, length, basis_mask=None):
+        self.packed_bits = packed_bits
+        self.length = length
+        self.basis_mask = basis_mask
+
+    @classmethod
+    def from_array(cls, array, basis_mask=None):
+        return cls(np.packbits(np.asarray(array, dtype=np.uint8)), len(array), basis_mask)
+
+    @classmethod
+    def from_bits(cls, bits, bases=None):
+        basis_mask = None if bases is None else bases_to_mask(list(bases))
+        return cls.from_array(bits_to_array(list(bits)), basis_mask)
+
+    def __len__(self):
+        return self.length
+
+    def unpack(self):
+        return np.unpackbits(self.packed_bits, count=self.length)
+
+    def to_bits(self):
+        return array_to_bits(self.unpack())
+
+    def to_bytes(self):
+        return self.packed_bits.tobytes()
+
+    def select(self, mask):
+        basis_mask = None if self.basis_mask is None else self.basis_mask[mask]
+        return PackedKey.from_array(self.unpack()[mask], basis_mask)
+
+    def same_bases(self, other):
+        return self.basis_mask == other.basis_mask
+
+    def count_errors(self, other):
+        # padding bits are zero in both keys, so they never count as errors
+        different_bits = np.bitwise_xor(self.packed_bits, other.packed_bits)
+        return int(POPCOUNT_TABLE[different_bits].sum())
+
+# entropy pool
+def memory_to_array(memory):
+    return np.frombuffer("".join(memory).encode(), dtype=np.uint8) - ord(BIT_0)
+
+
+def get_circuit_entropy(size):
+    # a Hadamard circuit ENTROPY_CIRCUIT_WIDTH qubits wide, one shot per row of bits
+    circuit = QuantumCircuit(ENTROPY_CIRCUIT_WIDTH, ENTROPY_CIRCUIT_WIDTH)
+    circuit.h(range(ENTROPY_CIRCUIT_WIDTH))
+    circuit.measure(range(ENTROPY_CIRCUIT_WIDTH), range(ENTROPY_CIRCUIT_WIDTH))
+    shots = -(-size // ENTROPY_CIRCUIT_WIDTH)
+
+    result = run_circuits(circuit, QasmSimulator(), shots, memory=True)
+
+    return memory_to_array(result.get_memory(0))[:size]
+
+
+def get_qrng_entropy(size):
+    # a single Hadamard qubit, measured once per shot
+    circuit = QuantumCircuit(1, 1)
+    circuit.h(0)
+    circuit.measure(0, 0)
+
+    result = run_circuits(circuit, QasmSimulator(), size, memory=True)
+
+    return memory_to_array(result.get_memory(0))
+
+
+def get_csprng_entropy(size):
+    random_bytes = np.frombuffer(secrets.token_bytes(-(-size // 8)), dtype=np.uint8)
+
+    return np.unpackbits(random_bytes)[:size]
+
+
+ENTROPY_SOURCES = {
+    CIRCUIT_ENTROPY: get_circuit_entropy,
+    QRNG_ENTROPY: get_qrng_entropy,
+    CSPRNG_ENTROPY: get_csprng_entropy,
+}
+
+
+class EntropyPool:
+    """Random bits drawn from a source in large batches, refilled on a background thread."""
+
+    def __init__(self, source=ENTROPY_SOURCE, capacity=ENTROPY_POOL_SIZE, refill_threshold=ENTROPY_REFILL_THRESHOLD):
+        self.source = ENTROPY_SOURCES[source]
+        self.capacity = capacity
+        self.refill_threshold = refill_threshold
+        self.buffer = np.empty(0, dtype=np.uint8)
+        self.position = 0
+        self.next_buffer = None
+        self.refill_thread = None
+        self.lock = threading.Lock()
+        self.start_refill()
+
+    def available(self):
+        return len(self.buffer) - self.position
+
+    def refill(self):
+        self.next_buffer = self.source(self.capacity)
+
+    def start_refill(self):
+        if self.refill_thread is None:
+            self.refill_thread = threading.Thread(target=self.refill, daemon=True)
+            self.refill_thread.start()
+
+    def swap_buffers(self):
+        self.start_refill()
+        self.refill_thread.join()
+        self.refill_thread = None
+
+        # a failed background refill is retried here, so its error reaches the caller
+        if self.next_buffer is None:
+            self.refill()
+
+        self.buffer, self.position, self.next_buffer = self.next_buffer, 0, None
+
+    def take(self, size):
+        chunks = [np.empty(0, dtype=np.uint8)]
+
+        with self.lock:
+            while size > 0:
+                if self.available() == 0:
+                    self.swap_buffers()
+
+                chunk = self.buffer[self.position:self.position + size]
+                self.position += len(chunk)
+                size -= len(chunk)
+                chunks.append(chunk)
+
+            # the next batch is prepared while the protocol uses this one
+            if self.available() < self.refill_threshold:
+                self.start_refill()
+
+        return np.concatenate(chunks)
+
+
+ENTROPY_SETTINGS = {"source": ENTROPY_SOURCE}
+ENTROPY_POOLS = {}
+
+
+def set_entropy_source(source):
+    if source not in ENTROPY_SOURCES:
+        raise ValueError(f"Unknown entropy source: {source}")
+
+    ENTROPY_SETTINGS["source"] = source
+
+
+def get_entropy_pool():
+    # keyed by process too, so forked workers never reuse their parent's buffer
+    key = (os.getpid(), ENTROPY_SETTINGS["source"])
+
+    if key not in ENTROPY_POOLS:
+        ENTROPY_POOLS[key] = EntropyPool(ENTROPY_SETTINGS["source"])
+
+    return ENTROPY_POOLS[key]